@@ -0,0 +1,21 @@
+import numpy as np
+
+
+def group_rows(codes, size):
+    """Positions of the rows of every code 0..size-1, each in increasing order"""
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=size))[:-1]
+    return np.split(order, bounds)
+
+
+def group_pairs(codes, positions):
+    """Every pair (i, j) of positions that share a code, i before j in the order of positions"""
+    order = np.argsort(codes, kind='stable')
+    positions, codes = positions[order], codes[order]
+    sizes = np.bincount(codes)
+    starts = np.cumsum(sizes) - sizes
+    # partners of every position: the later positions of its group
+    after = sizes[codes] - (np.arange(len(codes)) - starts[codes]) - 1
+    first = np.repeat(np.arange(len(codes)), after)
+    offset = np.arange(len(first)) - np.repeat(np.cumsum(after) - after, after)
+    return positions[first], positions[first + 1 + offset]
@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+from openpyxl import Workbook
+
+from utils import load_all_sheets, find_similar_products, remove_flavor_variants, process_excel_for_duplicates, \
+    find_normal_cases, candidate_recall
+
+BRANDS = ["NESTLE", "CAROZZI", "SOPROLE", "COLUN", "LUCCHETTI", "MCKAY", "COSTA", "AMBROSOLI", "WATTS", "AGROSUPER",
+          "IANSA", "TUCAPEL", "CUISINE & CO", "LIDER", "JUMBO", "ACUENTA", "CALO", "SURLAT", "MARCO POLO", "DONUTS",
+          "SAVORY", "BRESLER", "ARCOR", "EVERCRISP", "GATORADE", "ANDINA", "CCU", "CACHANTUN", "VIVO", "LOS CERRILLOS"]
+
+PRODUCTS = ["YOGHURT", "LECHE", "GALLETA", "CEREAL", "JUGO", "NECTAR", "BEBIDA", "HELADO", "SALSA", "MERMELADA",
+            "POSTRE", "BARRA", "CAFE", "TE", "FIDEOS", "ARROZ", "AZUCAR", "CHOCOLATE", "CARAMELO", "QUESO"]
+
+DESCRIPTORS = ["BATIDO", "DESCREMADO", "LIGHT", "ZERO", "TRADICIONAL", "CLASICO", "SUAVE", "INTENSO", "PREMIUM",
+               "FAMILIAR", "INSTANTANEO", "NATURAL", "SIN LACTOSA", "BOLSA", "TARRO", "CAJA", "DOYPACK"]
+
+FLAVORS = ["FRUTILLA", "VAINILLA", "CHOCOLATE", "PIÑA", "DURAZNO", "MANZANA", "NARANJA", "LIMON", "MENTA", "CANELA",
+           "CARAMELO", "FRAMBUESA", "MORA", "COCO", "PLATANO", "MANJAR", "NUEZ", "ARANDANO", "MANGO", "MARACUYA"]
+
+QUANTITIES = ["500 ML", "500ML", "1/2 KG", "180ML", "1 KG", "1 KG.", "250 GR", "250GR", "3.5 L", "1.5 LT", "20 UDS",
+              "165 CC", "X 6 UN", "(1)", "120 G", "1000 CC", "2 L", ""]
+
+
+def make_catalog(n_rows, sheets=6, rows_per_brand=2000, seed=0):
+    """
+    Synthetic catalog with the columns of load_all_sheets (Marca, Nombre SKU, SKU, Sheet), reproducible by seed.
+
+    Every brand has base products (product, descriptor, flavor, quantity) that the sheets (companies) list
+    with the noise of the real workbooks: reordered words, extra or missing words, lowercase and padded brands,
+    "PI¥A"-style encoding of Ñ, SKUs shifted by a few units or written as text, and flavor variants
+    (the same product in another flavor, a different product).
+    The number of brands grows with n_rows (rows_per_brand), so the cost of matching grows linearly.
+    """
+    rnd = random.Random(seed)
+    n_brands = max(1, n_rows // rows_per_brand)
+    sheet_names = [f"Empresa {k + 1}" for k in range(sheets)]
+
+    rows = []
+    for brand_idx in range(n_brands):
+        brand = BRANDS[brand_idx % len(BRANDS)]
+        if brand_idx >= len(BRANDS):
+            brand = f"{brand} {brand_idx // len(BRANDS)}"
+        brand_rows = n_rows * (brand_idx + 1) // n_brands - n_rows * brand_idx // n_brands
+
+        base = []
+        for _ in range(max(1, brand_rows // 3)):
+            words = [rnd.choice(PRODUCTS), rnd.choice(DESCRIPTORS), rnd.choice(FLAVORS)]
+            base.append((words, rnd.choice(QUANTITIES), rnd.randint(10000, 9999999)))
+
+        for _ in range(brand_rows):
+            words, quantity, sku = rnd.choice(base)
+            words = list(words)
+            if rnd.random() < 0.1:
+                # flavor variant, another product
+                words[2] = rnd.choice(FLAVORS)
+                sku = sku + rnd.randint(10, 1000)
+            if rnd.random() < 0.3:
+                rnd.shuffle(words)
+            if rnd.random() < 0.15:
+                words.append(rnd.choice(DESCRIPTORS))
+            if rnd.random() < 0.05:
+                words.pop(rnd.randrange(len(words)))
+            name = " ".join(words + [quantity]).strip()
+            if rnd.random() < 0.2:
+                name = name.replace("Ñ", "¥")
+            if rnd.random() < 0.1:
+                name = name.lower()
+            if rnd.random() < 0.2:
+                sku = sku + rnd.randint(-3, 3)
+            marca = brand if rnd.random() < 0.9 else f" {brand.title()} "
+            sku_value = sku if rnd.random() < 0.97 else f"CL-{sku}"
+            rows.append((marca, name, sku_value, rnd.choice(sheet_names)))
+
+    return pd.DataFrame(rows, columns=["Marca", "Nombre SKU", "SKU", "Sheet"])
+
+
+def write_catalog_workbook(df, path):
+    """Workbook like the real one: one sheet per company plus a Familia Corporativa sheet that is skipped"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Familia Corporativa")
+    ws.append(["Empresa", "Holding"])
+    for sheet, rows in df.groupby("Sheet", sort=True):
+        ws = wb.create_sheet(sheet)
+        ws.append(["Marca", "Nombre SKU", "SKU"])
+        for row in rows[["Marca", "Nombre SKU", "SKU"]].itertuples(index=False, name=None):
+            ws.append(list(row))
+    wb.save(path)
+
+
+def timed(function, *args, **kwargs):
+    """Result of the call and its wall time in seconds"""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def output_rows(result):
+    """Rows of a stage result, tables of a tuple are added"""
+    if isinstance(result, tuple):
+        return sum(len(table) for table in result)
+    return len(result)
+
+
+def benchmark_size(n_rows, similarity_threshold=90, seed=0, workdir=None):
+    """Times every stage of the pipeline on a synthetic catalog of n_rows, one record per stage.
+    The workbook is written to workdir, by default to a temporary folder that is removed afterwards.
+    No stage uses the load cache, every stage that reads the workbook parses it"""
+    if workdir is None:
+        with tempfile.TemporaryDirectory(prefix="prisa-eda-bench-") as tmp:
+            return benchmark_size(n_rows, similarity_threshold, seed, tmp)
+
+    df = make_catalog(n_rows, seed=seed)
+    path = os.path.join(workdir, f"catalog_{n_rows}.xlsx")
+    write_catalog_workbook(df, path)
+
+    records = []
+
+    def record(stage, seconds, result):
+        records.append({"rows": n_rows, "stage": stage, "seconds": round(seconds, 4),
+                        "output_rows": output_rows(result)})
+        print(f"{n_rows:>9} rows  {stage:<32} {seconds:9.3f} s  {output_rows(result)} rows out")
+
+    catalog, seconds = timed(load_all_sheets, path, cache_dir=None)
+    record("load_all_sheets", seconds, catalog)
+
+    pairs, seconds = timed(find_similar_products, catalog.copy(), similarity_threshold)
+    record("find_similar_products", seconds, pairs)
+
+    filtered, seconds = timed(remove_flavor_variants, pairs.copy())
+    record("remove_flavor_variants", seconds, filtered)
+
+    tables, seconds = timed(process_excel_for_duplicates, path, cache_dir=None)
+    record("process_excel_for_duplicates", seconds, tables)
+
+    unique, seconds = timed(find_normal_cases, path, cache_dir=None)
+    record("find_normal_cases", seconds, unique)
+
+    return records
+
+
+def check_recall(sizes=(2000, 10000), thresholds=(77, 88, 90, 93), seed=0):
+    """
+    Recall of the q-gram candidate index against the exhaustive scoring (utils.candidate_recall)
+    on synthetic catalogs. The index must be lossless: raises AssertionError when a recall is below 1.0
+    """
+    reports = []
+    for n_rows in sizes:
+        report = candidate_recall(make_catalog(n_rows, seed=seed), thresholds).assign(rows=n_rows)
+        print(report.to_string(index=False))
+        lost = report[report["Recall"] < 1.0]
+        assert lost.empty, f"candidate index lost matches on {n_rows} rows:\n{lost.to_string(index=False)}"
+        reports.append(report)
+    return pd.concat(reports, ignore_index=True)
+
+
+def git_commit():
+    """Commit of the working tree, None outside a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(sizes=(1000, 10000, 100000, 1000000), output="benchmark.json", similarity_threshold=90, seed=0):
+    """Runs benchmark_size for every size and writes the records with the versions of the run to output (JSON)"""
+    import numpy
+    import rapidfuzz
+
+    results = []
+    for n_rows in sizes:
+        results.extend(benchmark_size(n_rows, similarity_threshold, seed))
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": numpy.__version__,
+        "rapidfuzz": rapidfuzz.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "similarity_threshold": similarity_threshold,
+        "seed": seed,
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark saved as '{output}'")
+    return report
+
+
+def compare_benchmarks(baseline_path, current_path):
+    """Seconds of both runs per size and stage, Ratio > 1 means the current run is slower"""
+    frames = []
+    for path, label in [(baseline_path, "Baseline"), (current_path, "Current")]:
+        with open(path) as f:
+            results = pd.DataFrame(json.load(f)["results"])
+        frames.append(results.set_index(["rows", "stage"])["seconds"].rename(f"{label} seconds"))
+    table = pd.concat(frames, axis=1)
+    table["Ratio"] = (table["Current seconds"] / table["Baseline seconds"]).round(3)
+    return table.reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling benchmark of the duplicate pipeline on synthetic catalogs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--threshold", type=int, default=90)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", metavar="BASELINE_JSON", help="print the ratio against an earlier run")
+    parser.add_argument("--check-recall", action="store_true",
+                        help="only check that the candidate index finds every match of the exhaustive scoring")
+    args = parser.parse_args()
+
+    if args.check_recall:
+        check_recall(args.sizes, seed=args.seed)
+        raise SystemExit
+    run_benchmark(args.sizes, args.output, args.threshold, args.seed)
+    if args.compare:
+        print(compare_benchmarks(args.compare, args.output).to_string(index=False))
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# root of the caches, the environment variable PRISA_EDA_CACHE_DIR moves it
+DEFAULT_CACHE_DIR = os.environ.get("PRISA_EDA_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "prisa-eda")
+
+
+def file_digest(path):
+    """sha256 of the file content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def params_digest(*parts):
+    """sha256 of the repr of the parts, for keys made of parameters"""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+# value types of a column mixing text and numbers, stored as codes in the column "<name> (type)"
+MIXED_TYPES = ['text', 'int', 'float', 'missing']
+
+
+def mixed_type_codes(values):
+    """MIXED_TYPES code of every value of an object column, None if a value is of another type"""
+    codes = np.empty(len(values), dtype=np.uint8)
+    for k, value in enumerate(values):
+        if isinstance(value, str):
+            codes[k] = 0
+        elif isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_)):
+            codes[k] = 1
+        elif isinstance(value, (float, np.floating)):
+            codes[k] = 3 if value != value else 2
+        elif value is None:
+            codes[k] = 3
+        else:
+            return None
+    return codes
+
+
+def encode_mixed(df):
+    """
+    Object columns that mix text and numbers (SKU columns with codes like "CL-123") as text, plus a column
+    "<name> (type)" with the MIXED_TYPES code of every value, so parquet can store them. decode_mixed reverses it
+    """
+    encoded = df
+    for column in df.columns:
+        values = df[column]
+        if values.dtype != object or pd.api.types.infer_dtype(values, skipna=True) not in ('mixed-integer', 'mixed'):
+            continue
+        codes = mixed_type_codes(values.to_numpy())
+        if codes is None:
+            continue
+        if encoded is df:
+            encoded = df.copy()
+        encoded[column] = pd.Series([None if code == 3 else str(value) for value, code in zip(values, codes)],
+                                    index=df.index, dtype=object)
+        encoded[f'{column} (type)'] = codes
+    return encoded
+
+
+def decode_mixed(df):
+    """The columns of encode_mixed with their values back, numbers as int or float"""
+    for type_column in [column for column in df.columns if column.endswith(' (type)')]:
+        column = type_column[:-len(' (type)')]
+        codes = df[type_column].to_numpy()
+        text = df[column].to_numpy(dtype=object)
+        values = np.full(len(df), np.nan, dtype=object)
+        values[codes == 0] = text[codes == 0]
+        values[codes == 1] = [int(value) for value in text[codes == 1]]
+        values[codes == 2] = [float(value) for value in text[codes == 2]]
+        df[column] = pd.Series(values, index=df.index, dtype=object)
+        df = df.drop(columns=type_column)
+    return df
+
+
+def save_frame(df, path):
+    """
+    Saves a frame as <path>.parquet. Columns mixing text and numbers (SKU) are stored as text plus their types
+    (see encode_mixed), and read back as they were by load_frame. Only a frame parquet can not store even so,
+    or a missing parquet engine, falls back to <path>.pkl with a RuntimeWarning.
+    The file is written to a temporary name first, so a broken run never leaves a half written cache.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        target = path + '.parquet'
+        encode_mixed(df).to_parquet(target + '.tmp')
+    except (ImportError, ValueError, TypeError) as e:
+        warnings.warn(f"Parquet not available for {path} ({e}), using pickle", RuntimeWarning, stacklevel=2)
+        if os.path.exists(target + '.tmp'):
+            os.remove(target + '.tmp')
+        target = path + '.pkl'
+        df.to_pickle(target + '.tmp')
+    os.replace(target + '.tmp', target)
+    return target
+
+
+def load_frame(path):
+    """Frame saved by save_frame, None if there is none"""
+    if os.path.exists(path + '.parquet'):
+        return decode_mixed(pd.read_parquet(path + '.parquet'))
+    if os.path.exists(path + '.pkl'):
+        return pd.read_pickle(path + '.pkl')
+    return None
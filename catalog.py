@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+# text columns of the catalog stored as categoricals: every distinct value is kept once and rows hold codes
+CATEGORY_COLUMNS = ['Marca', 'Sheet', 'Nombre SKU']
+
+
+def compact_catalog(df):
+    """
+    Compact copy of a catalog of load_all_sheets, with the same values and far less memory.
+    Marca, Sheet and Nombre SKU become categoricals (dictionary encoding, repeated names are stored once).
+    SKU becomes int64 when every SKU is an integer, otherwise a categorical: integer codes per row
+    and the distinct SKUs, numbers and text, as the side table.
+    Other columns are kept as they are. Every function of utils accepts the compact catalog.
+    """
+    compact = df.copy()
+    for column in CATEGORY_COLUMNS:
+        if column in compact.columns:
+            compact[column] = compact[column].astype('category')
+    if 'SKU' in compact.columns:
+        compact['SKU'] = compact_skus(compact['SKU'])
+    return compact
+
+
+def compact_skus(skus):
+    """SKU column as int64 when every value is an integer, otherwise as a categorical.
+    Numeric columns (floats are integers with blanks) are already compact and kept as they are"""
+    if pd.api.types.is_numeric_dtype(skus.dtype) or isinstance(skus.dtype, pd.CategoricalDtype):
+        return skus
+    if len(skus) and pd.api.types.infer_dtype(skus, skipna=False) == 'integer':
+        return skus.astype(np.int64)
+    return skus.astype('category')
+
+
+def is_compact(df):
+    """True if any text column of the catalog is a categorical"""
+    return any(isinstance(df[column].dtype, pd.CategoricalDtype) for column in CATEGORY_COLUMNS if column in df.columns)
+
+
+def column_codes(values):
+    """
+    Integer code for every row of a column and the value of every code, like
+    pd.factorize(values, use_na_sentinel=False): codes in order of first appearance, missing values get a code.
+    Categoricals are encoded from their codes, without reading the strings
+    """
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+        category_codes = np.asarray(values.cat.codes if isinstance(values, pd.Series) else values.codes)
+        codes, used = pd.factorize(category_codes)
+        categories = np.asarray(values.cat.categories if isinstance(values, pd.Series) else values.categories,
+                                dtype=object)
+        uniques = np.empty(len(used), dtype=object)
+        uniques[used >= 0] = categories[used[used >= 0]]
+        uniques[used < 0] = np.nan
+        return codes, uniques
+
+    if not (isinstance(values, (pd.Series, pd.Index)) and pd.api.types.is_numeric_dtype(values.dtype)):
+        values = np.asarray(values, dtype=object)
+    return pd.factorize(values, use_na_sentinel=False)
+
+
+def take_values(codes, values, categorical=False):
+    """values[codes], as a categorical when categorical (values may repeat, they are encoded again)"""
+    if not categorical:
+        return np.asarray(values, dtype=object)[codes]
+    value_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    return pd.Categorical.from_codes(value_codes[codes], uniques)
@@ -0,0 +1,167 @@
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+import requests
+
+from web_srapping import download_images, resolve_product_urls
+
+
+class LocalServer:
+    """
+    A ThreadingHTTPServer on localhost running in a thread, for the checks of this file.
+    handle(path) -> (status, body) answers every GET, the GETs of every path are counted in hits
+    """
+
+    def __init__(self, handle):
+        self.hits = {}
+        lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with lock:
+                    server.hits[self.path] = server.hits.get(self.path, 0) + 1
+                status, body = handle(self.path)
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def check_downloads(n_images=20):
+    """
+    download_images against a local server, with a temporary cache: n_images images, one url that answers 503
+    twice before 200 (retried), one 404 (an error row, the batch goes on), two urls with the same content
+    (one cached object), a code without url and a url repeated for two codes (downloaded once).
+    A second run downloads nothing. Raises AssertionError when a check fails
+    """
+    flaky = {"count": 0}
+
+    def handle(path):
+        if path == "/flaky.png":
+            flaky["count"] += 1
+            return (503, b"") if flaky["count"] < 3 else (200, b"image flaky")
+        if path == "/missing.png":
+            return 404, b""
+        if path.startswith("/same"):
+            return 200, b"same image"
+        return 200, f"image {path}".encode()
+
+    with LocalServer(handle) as server, tempfile.TemporaryDirectory(prefix="prisa-eda-check-") as tmp:
+        cache_dir, folder = os.path.join(tmp, "cache"), os.path.join(tmp, "images")
+        items = [(code, f"{server.url}/{code}.png") for code in range(n_images)]
+        items += [("flaky", f"{server.url}/flaky.png"), ("missing", f"{server.url}/missing.png"),
+                  ("same1", f"{server.url}/same1.png"), ("same2", f"{server.url}/same2.png"),
+                  ("no url", None), ("copy", f"{server.url}/1.png")]
+
+        start = time.perf_counter()
+        first = download_images(items, folder, cache_dir, workers=8, backoff=0.01).set_index("Code")
+        print(f"first run  {time.perf_counter() - start:6.2f} s  {first['Error'].isna().sum()} images")
+
+        assert server.hits["/flaky.png"] == 3, "the 503 answers were not retried"
+        assert pd.isna(first.loc["flaky", "Error"])
+        assert first.loc["missing", "Error"] == "Status code 404" and pd.isna(first.loc["missing", "Path"])
+        assert first.loc["no url", "Error"] == "No url"
+        assert server.hits["/1.png"] == 1, "a url of two codes was downloaded twice"
+        assert first.loc["same1", "Path"] == first.loc["same2", "Path"], "same content stored twice"
+        assert first["Error"].isna().sum() == n_images + 4
+        with open(os.path.join(folder, "flaky.png"), "rb") as f:
+            assert f.read() == b"image flaky"
+
+        hits = dict(server.hits)
+        start = time.perf_counter()
+        second = download_images(items, folder, cache_dir, workers=8, backoff=0.01).set_index("Code")
+        print(f"second run {time.perf_counter() - start:6.2f} s  {second['Cached'].sum()} cached")
+
+        downloaded = {path: n - hits.get(path, 0) for path, n in server.hits.items() if n != hits.get(path, 0)}
+        assert downloaded == {"/missing.png": 1}, f"the second run downloaded {downloaded}"
+        assert second["Cached"].sum() == n_images + 4
+        assert (second["Path"].dropna() == first["Path"].dropna()).all()
+    print("download checks passed")
+
+
+class StoreBackend:
+    """A resolve_product_urls backend that searches a local fake store with requests, one session per backend"""
+
+    created = []
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.closed = False
+        StoreBackend.created.append(self)
+
+    def lookup(self, product_code):
+        response = self.session.get(f"{self.base_url}/search?q={product_code}", timeout=10)
+        response.raise_for_status()
+        found = re.search(r'src="([^"]+)"', response.text)
+        return self.base_url + found.group(1) if found else None
+
+    def close(self):
+        self.closed = True
+        self.session.close()
+
+
+def check_url_resolution(n_codes=20, workers=4):
+    """
+    resolve_product_urls with StoreBackend against a local fake store, with a temporary cache: n_codes codes
+    resolved by at most workers backends (a failing backend is replaced), a code that is not in the store
+    (no url), a code whose search fails with 500 (an error row, the batch goes on) and a repeated code.
+    A second run looks up only the codes without url. Raises AssertionError when a check fails
+    """
+    def handle(path):
+        code = path.split("q=", 1)[1]
+        if code == "broken":
+            return 500, b""
+        if code.startswith("9"):
+            return 200, b"<p>no results</p>"
+        return 200, f'<img src="/img/{code}.png">'.encode()
+
+    with LocalServer(handle) as server, tempfile.TemporaryDirectory(prefix="prisa-eda-check-") as cache_dir:
+        codes = [str(code) for code in range(10, 10 + n_codes)] + ["901", "broken", 10]
+        StoreBackend.created = []
+        first = resolve_product_urls(codes, lambda: StoreBackend(server.url), workers, cache_dir).set_index("Code")
+        print(f"first run  {len(first)} codes  {first['URL'].notna().sum()} urls  "
+              f"{len(StoreBackend.created)} backends")
+
+        assert len(first) == n_codes + 2, "a repeated code was not merged"
+        assert first["URL"].notna().sum() == n_codes
+        assert first.loc["15", "URL"] == f"{server.url}/img/15.png"
+        assert pd.isna(first.loc["901", "URL"]) and pd.isna(first.loc["901", "Error"])
+        assert first.loc["broken", "Error"].startswith("HTTPError"), "the failing code has no error"
+        # one backend per worker, plus the one that replaces the backend of the failing code
+        assert len(StoreBackend.created) <= workers + 1, f"{len(StoreBackend.created)} backends for {workers} workers"
+        assert all(backend.closed for backend in StoreBackend.created)
+
+        StoreBackend.created = []
+        second = resolve_product_urls(codes, lambda: StoreBackend(server.url), workers, cache_dir).set_index("Code")
+        print(f"second run {second['Cached'].sum()} cached  {len(StoreBackend.created)} backends")
+        searched = {path for path, n in server.hits.items() if n > 1}
+        assert second["Cached"].sum() == n_codes
+        assert searched == {"/search?q=901", "/search?q=broken"}, f"the second run searched again {searched}"
+        assert (second["URL"].dropna() == first["URL"].dropna()).all()
+    print("url resolution checks passed")
+
+
+if __name__ == "__main__":
+    check_downloads()
+    check_url_resolution()
@@ -0,0 +1,147 @@
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+from array_utils import group_rows
+from catalog import column_codes, compact_skus
+
+PRODUCT_COLUMNS = ['Marca', 'Nombre SKU', 'SKU', 'Sheet']
+
+
+def sheet_counts(sheets, exclude=(), sort=False):
+    """{sheet: number of rows} of a column of sheets in one groupby, sheets in exclude are left out.
+    Sheets in order of first appearance, or sorted by name with sort (also for a categorical column)"""
+    sheets = pd.Series(sheets)
+    counts = sheets.groupby(sheets, sort=False, observed=True).size().items()
+    return {sheet: int(n) for sheet, n in (sorted(counts) if sort else counts) if sheet not in exclude}
+
+
+def side_column(first, second):
+    """The values of two columns one after the other as a categorical, codes in order of first appearance"""
+    codes, uniques = pd.factorize(np.concatenate([np.asarray(first, dtype=object), np.asarray(second, dtype=object)]))
+    return pd.Categorical.from_codes(codes, pd.Index(uniques, dtype=object))
+
+
+class PairStore:
+    """
+    A pair table (wide: Nombre SKU 1, SKU 1, Sheet 1 ... for both products) with its long format,
+    one row per side of every pair (an edge list), built once and kept: the products and
+    the counts per sheet are read from it without splitting the table again.
+    A store made by subset only has the sides (pairs is None)
+    """
+
+    def __init__(self, pairs, sides=None):
+        self.pairs = pairs
+        self._sides = sides
+        self._product_rows = None
+
+    def __len__(self):
+        return len(self.pairs) if self.pairs is not None else len(self.sides()) // 2
+
+    def sides(self):
+        """Both sides of every pair as rows with Marca, Nombre SKU, SKU, Sheet (categoricals, SKU compact),
+        Pair (uint32 position of the pair) and Side (uint8, 1 or 2): side 1 of every pair, then side 2.
+        Row k is side 1 of pair k for k < len(pairs), otherwise side 2 of pair k - len(pairs)"""
+        if self._sides is None:
+            pairs = self.pairs
+            self._sides = pd.DataFrame({
+                'Marca': side_column(pairs['Marca'], pairs['Marca']),
+                'Nombre SKU': side_column(pairs['Nombre SKU 1'], pairs['Nombre SKU 2']),
+                'SKU': compact_skus(pd.concat([pairs['SKU 1'], pairs['SKU 2']], ignore_index=True)),
+                'Sheet': side_column(pairs['Sheet 1'], pairs['Sheet 2']),
+                'Pair': np.tile(np.arange(len(pairs), dtype=np.uint32), 2),
+                'Side': np.repeat(np.array([1, 2], dtype=np.uint8), len(pairs)),
+            })
+        return self._sides
+
+    def subset(self, rows):
+        """Store of the pairs at positions rows (in that order), its sides are taken from the sides of this store
+        instead of splitting the pair table again. Pair is the position in rows"""
+        rows = np.asarray(rows, dtype=np.int64)
+        sides = self.sides().take(np.concatenate([rows, rows + len(self)])).reset_index(drop=True)
+        sides['Pair'] = np.tile(np.arange(len(rows), dtype=np.uint32), 2)
+        return PairStore(None, sides)
+
+    def product_rows(self):
+        """Rows of sides() with the first appearance of every product (Marca, Nombre SKU, SKU, Sheet)"""
+        if self._product_rows is None:
+            self._product_rows = np.flatnonzero(~self.sides().duplicated(subset=PRODUCT_COLUMNS).to_numpy())
+        return self._product_rows
+
+    def products(self):
+        """The distinct products (Marca, Nombre SKU, SKU, Sheet) of the pairs, in order of first appearance"""
+        return self.sides().iloc[self.product_rows()].loc[:, PRODUCT_COLUMNS].reset_index(drop=True)
+
+    def products_per_sheet(self, exclude=()):
+        """{sheet: number of distinct products}, sheets sorted"""
+        return sheet_counts(self.products()['Sheet'], exclude, sort=True)
+
+
+class CompanyPairs(Mapping):
+    """
+    A pair table split by company (sheet), as a read only dict {company: pairs where Sheet 1 or Sheet 2
+    is the company}. The table is held in a PairStore (store), both sheet columns of its sides are grouped
+    once into an index of row positions per company.
+    The first company asked for builds the table sorted by company in one take (a pair is there once per
+    company it has), every company is then a slice of it: no copy per company and the dtypes of the table are kept.
+    companies fixes the keys and their order (companies without pairs get an empty frame),
+    by default the sheets of the table in order of first appearance (Sheet 1, then Sheet 2)
+    """
+
+    def __init__(self, pairs, companies=None):
+        self.pairs = pairs
+        self.store = PairStore(pairs)
+        codes, uniques = column_codes(self.store.sides()['Sheet'])
+        self.side_codes = codes
+        # rows of sides() of every company
+        self.side_positions = group_rows(codes, len(uniques))
+        self.codes = {company: code for code, company in enumerate(uniques)}
+        self.companies = list(uniques) if companies is None else list(companies)
+        self._company_set = set(self.companies)
+        self._by_company = None
+        self._offsets = None
+
+    def __len__(self):
+        """Number of companies"""
+        return len(self.companies)
+
+    def __iter__(self):
+        return iter(self.companies)
+
+    def __contains__(self, company):
+        return company in self._company_set
+
+    def __getitem__(self, company):
+        if company not in self:
+            raise KeyError(company)
+        code = self.codes.get(company)
+        if code is None:
+            return self.pairs.iloc[:0]
+        by_company, offsets = self.sorted_by_company()
+        return by_company.iloc[offsets[code]:offsets[code + 1]]
+
+    def sorted_by_company(self):
+        """The pairs of every company one after the other (company code order, table order within a company)
+        and the offsets of the companies: the pairs of code c are rows offsets[c]:offsets[c + 1]"""
+        if self._by_company is None:
+            positions = [self.positions(company) for company in self.codes]
+            self._offsets = np.concatenate([[0], np.cumsum([len(rows) for rows in positions])])
+            self._by_company = self.pairs.take(np.concatenate(positions + [np.zeros(0, dtype=np.int64)]))
+        return self._by_company, self._offsets
+
+    def positions(self, company):
+        """Row positions of the pairs of a company, in table order"""
+        code = self.codes.get(company)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(self.side_positions[code] % max(len(self.pairs), 1))
+
+    def unique_products(self):
+        """{company: the distinct products (Marca, Nombre SKU, SKU, Sheet) of the company in its pairs}.
+        The products of the whole table are grouped once by sheet, every product belongs to one company"""
+        products = self.store.products()
+        product_positions = group_rows(self.side_codes[self.store.product_rows()], len(self.codes))
+        empty = np.zeros(0, dtype=np.int64)
+        return {company: products.iloc[product_positions[self.codes[company]] if company in self.codes else empty]
+                .reset_index(drop=True) for company in self.companies}
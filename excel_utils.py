@@ -1,11 +1,17 @@
 import pandas as pd
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill, Font
 from openpyxl.utils import get_column_letter
+from utils import PairTable
 
 
 def prepare_df(df, key):
     """Helper function for save_products_pairs_to_excel"""
+    if isinstance(df, PairTable):
+        # only the exported columns are read from the catalog, Numbers are never built
+        df = df.to_frame(["Marca", "Nombre SKU 1", "SKU 1", "Sheet 1", "Nombre SKU 2", "SKU 2", "Sheet 2",
+                          "Similarity"])
     df = df.copy()
     CATEGORY_MAP = {
         "exact_matches": "same name, same sku",
@@ -42,9 +48,87 @@ def prepare_df(df, key):
     return df
 
 
-def save_products_pairs_to_excel(exact_matches, partial_matches, confident, needs_review, filtered):
+# header of the company report (pandas 3 to_excel writes a plain header, the pairs file keeps it plain)
+HEADER_FONT = Font(bold=True)
+
+# rows converted to cells at a time
+CHUNK_ROWS = 10000
+
+
+def is_missing(value):
+    """None and NaN-like values, written as empty cells"""
+    return value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and value != value)
+
+
+def text_width(values):
+    """Length of the longest non empty value as text, 0 if there is none"""
+    return max((len(str(value)) for value in values if not is_missing(value) and value), default=0)
+
+
+def write_sheet(output_file, sections, sheet_name="Sheet1", column_colors=None, column_widths=None,
+                default_width=None, freeze_panes=None, bold_header=False):
+    """
+    Writes sections of rows to a new workbook in openpyxl write-only mode. Rows are streamed to the file
+    with their style, so no cell model of the sheet is kept in memory.
+
+    sections: list of (df, color), all with the same columns, every cell of the rows of df gets the fill color
+    (None for no fill). column_colors: fill of the data cells of a column, for sections without color.
+    column_widths: width of a column, the others get default_width or the length of their longest value + 4.
+    The header is plain, like the header of to_excel with pandas 3, or bold with bold_header.
+    """
+    column_colors = column_colors or {}
+    column_widths = column_widths or {}
+    columns = list(sections[0][0].columns)
+    fills = {}
+
+    def fill_of(color):
+        if color not in fills:
+            fills[color] = PatternFill(start_color=color, end_color=color, fill_type="solid")
+        return fills[color]
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+
+    # widths and panes have to be set before the first row is written
+    for col_idx, column in enumerate(columns, start=1):
+        width = column_widths.get(column, default_width)
+        if width is None:
+            longest = max([len(str(column))] + [text_width(df[column]) for df, _ in sections])
+            width = longest + 4
+        ws.column_dimensions[get_column_letter(col_idx)].width = width
+    if freeze_panes is not None:
+        ws.freeze_panes = freeze_panes
+
+    header = []
+    for column in columns:
+        cell = WriteOnlyCell(ws, value=column)
+        if bold_header:
+            cell.font = HEADER_FONT
+        header.append(cell)
+    ws.append(header)
+
+    for df, color in sections:
+        row_fills = [fill_of(color) if color else fill_of(column_colors[column]) if column in column_colors
+                     else None for column in columns]
+        for start in range(0, len(df), CHUNK_ROWS):
+            chunk = df.iloc[start:start + CHUNK_ROWS].astype(object)
+            for values in chunk.itertuples(index=False, name=None):
+                row = []
+                for value, fill in zip(values, row_fills):
+                    cell = WriteOnlyCell(ws, value=None if is_missing(value) else value)
+                    if fill is not None:
+                        cell.fill = fill
+                    row.append(cell)
+                ws.append(row)
+
+    wb.save(output_file)
+
+
+def save_products_pairs_to_excel(exact_matches, partial_matches, confident, needs_review, filtered,
+                                 output_file="/home/viktoria/Downloads/pairs_of_products.xlsx"):
     """
     Save matched product pairs to an Excel file with coloring and consistent formatting.
+    The rows are streamed by write_sheet, each table with the color of its category.
     """
 
     COLOR_MAP = {
@@ -63,44 +147,8 @@ def save_products_pairs_to_excel(exact_matches, partial_matches, confident, need
         "filtered": filtered,
     }
 
-    dfs = []
     order = ["exact_matches", "partial_matches", "confident", "needs_review", "filtered"]
-    for key in order:
-        df = prepare_df(tables[key], key)
-        dfs.append(df)
-
-    combined_df = pd.concat(dfs, ignore_index=True)
-
-    output_file = "/home/viktoria/Downloads/pairs_of_products.xlsx"
-    combined_df.to_excel(output_file, index=False, sheet_name="Subempresa")
-
-    wb = load_workbook(output_file)
-    ws = wb["Subempresa"]
-
-    row_to_color = {}
-    row_idx = 2
-
-    for key, df in zip(order, dfs):
-        for _ in range(len(df)):
-            row_to_color[row_idx] = COLOR_MAP[key]
-            row_idx += 1
-
-    for row, color in row_to_color.items():
-        fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
-        for col in range(1, ws.max_column + 1):
-            ws.cell(row=row, column=col).fill = fill
-
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            try:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
-            except:
-                pass
-        adjusted_width = max_length + 4
-        ws.column_dimensions[column].width = adjusted_width
+    sections = [(prepare_df(tables[key], key), COLOR_MAP[key]) for key in order]
 
-    wb.save(output_file)
+    write_sheet(output_file, sections, sheet_name="Subempresa")
     print(f"Excel file saved as '{output_file}'")
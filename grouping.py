@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+
+def connected_components(n, left, right):
+    """
+    Array-backed union-find over n nodes joined by the edges (left[k], right[k]).
+    Every round hooks each root to the smallest root among its edges and then compresses
+    the paths (parent = parent[parent]) until every node points to its root.
+    Returns the root of every node, the smallest node of its component.
+    """
+    parent = np.arange(n)
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+
+    while True:
+        root_left, root_right = parent[left], parent[right]
+        if (root_left == root_right).all():
+            return parent
+
+        lowest = np.minimum(root_left, root_right)
+        np.minimum.at(parent, root_left, lowest)
+        np.minimum.at(parent, root_right, lowest)
+
+        # path compression
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+
+def product_ids(df):
+    """
+    Integer id for every product (Nombre SKU, SKU) of a pair table, in order of first appearance.
+    Returns ids of side 1, ids of side 2 and a frame with Nombre SKU and SKU of every id
+    """
+    names = np.concatenate([df['Nombre SKU 1'].to_numpy(dtype=object), df['Nombre SKU 2'].to_numpy(dtype=object)])
+    skus = np.concatenate([df['SKU 1'].to_numpy(dtype=object), df['SKU 2'].to_numpy(dtype=object)])
+
+    name_codes, name_uniques = pd.factorize(names, use_na_sentinel=False)
+    sku_codes, _ = pd.factorize(skus, use_na_sentinel=False)
+    ids, _ = pd.factorize(name_codes.astype(np.int64) * (sku_codes.max(initial=0) + 1) + sku_codes)
+
+    first = np.unique(ids, return_index=True)[1]
+    products = pd.DataFrame({'Nombre SKU': names[first], 'SKU': skus[first]})
+    return ids[:len(df)], ids[len(df):], products
+
+
+def group_products(df):
+    """
+    Groups the products of a pair table: products matched in any row end up in the same group.
+    Returns one row per product with Nombre SKU, SKU, Group (ids in order of first appearance)
+    and Sheets (how many different sheets the group appears in)
+    """
+    if df.empty:
+        return pd.DataFrame(columns=['Nombre SKU', 'SKU', 'Group', 'Sheets'])
+
+    ids1, ids2, products = product_ids(df)
+    roots = connected_components(len(products), ids1, ids2)
+    groups, _ = pd.factorize(roots)
+
+    sheets = np.concatenate([df['Sheet 1'].to_numpy(dtype=object), df['Sheet 2'].to_numpy(dtype=object)])
+    sheet_codes, _ = pd.factorize(sheets, use_na_sentinel=False)
+    group_of_side = groups[np.concatenate([ids1, ids2])]
+    group_sheets = np.unique(np.stack([group_of_side, sheet_codes]), axis=1)
+    sheets_per_group = np.bincount(group_sheets[0], minlength=groups.max() + 1)
+
+    products['Group'] = groups
+    products['Sheets'] = sheets_per_group[groups]
+    return products
+
+
+def group_distribution(products):
+    """How many groups of group_products appear in 1, 2, 3... sheets"""
+    per_group = products.drop_duplicates('Group')['Sheets']
+    return {int(sheets): int(count) for sheets, count in per_group.value_counts().sort_index().items()}
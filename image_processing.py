@@ -1,6 +1,21 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
 from PIL import Image
 import imagehash
 
+from cache import DEFAULT_CACHE_DIR, save_frame, load_frame
+from array_utils import group_pairs
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp')
+
+# pHash only looks at a 32x32 thumbnail: JPEGs are decoded at the smallest scale of at least this size
+HASH_DECODE_SIZE = 128
+# images over this many pixels are rejected instead of decoded (PIL decompression bomb check)
+MAX_IMAGE_PIXELS = 50_000_000
+
 def are_images_similar(image_path1, image_path2, threshold=5):
     """
     Compare two images using perceptual hash (pHash).
@@ -52,6 +67,223 @@ def is_same_product_image(img_path1, img_path2, threshold=4):
         return False
 
 
+def hash_to_int(image_hash):
+    """64 bit integer of an 8x8 ImageHash, bits in row order"""
+    return int.from_bytes(np.packbits(image_hash.hash.flatten()).tobytes(), 'big')
+
+
+def image_phash(path, decode_size=HASH_DECODE_SIZE):
+    """
+    pHash of an image file as a 64 bit integer. Image.draft lets the JPEG decoder skip most of the work
+    (DCT scaling to about decode_size); other formats are decoded in full and reduced before hashing.
+    The reduced image can move the hash by a few bits: decode_size=None decodes the image in full,
+    the hash is then the same as the one of is_same_product_image
+    """
+    with Image.open(path) as image:
+        if decode_size is None:
+            return hash_to_int(imagehash.phash(image.convert("RGB")))
+        image.draft('RGB', (decode_size, decode_size))
+        image = image.convert("RGB")
+        if min(image.size) >= 2 * decode_size:
+            image = image.reduce(min(image.size) // decode_size)
+        return hash_to_int(imagehash.phash(image))
+
+
+def _limit_worker(max_pixels, max_memory_mb):
+    """Initializer of the hashing processes: pixel limit and, on Unix, an address space limit"""
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    if max_memory_mb:
+        import resource
+        limit = max_memory_mb * 2 ** 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _hash_file(path, decode_size=HASH_DECODE_SIZE):
+    """(path, hash, None) or (path, None, error message)"""
+    try:
+        return path, image_phash(path, decode_size), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def hash_images(paths, workers=1, decode_size=HASH_DECODE_SIZE, max_pixels=MAX_IMAGE_PIXELS, max_memory_mb=None,
+                chunksize=16):
+    """
+    pHash of many image files. workers > 1 hashes them on a process pool, max_memory_mb limits
+    the memory of every worker process. Returns hashes ({path: 64 bit hash}) and errors ({path: message})
+    for the files that could not be read, nothing is printed
+    """
+    paths = list(paths)
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(workers, initializer=_limit_worker, initargs=(max_pixels, max_memory_mb)) as pool:
+            results = list(pool.map(_hash_file, paths, [decode_size] * len(paths), chunksize=chunksize))
+    else:
+        previous = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = max_pixels
+        try:
+            results = [_hash_file(path, decode_size) for path in paths]
+        finally:
+            Image.MAX_IMAGE_PIXELS = previous
+
+    hashes = {path: value for path, value, error in results if error is None}
+    errors = {path: error for path, value, error in results if error is not None}
+    return hashes, errors
+
+
+def hamming_distances(hashes_a, hashes_b):
+    """Hamming distance between aligned (or broadcast) arrays of 64 bit hashes"""
+    return np.bitwise_count(np.bitwise_xor(np.asarray(hashes_a, dtype=np.uint64),
+                                           np.asarray(hashes_b, dtype=np.uint64))).astype(np.int64)
+
+
+def hash_chunks(max_distance):
+    """
+    Bit ranges (low, high) that split the 64 bit hash in max_distance + 1 chunks. Two hashes within
+    max_distance differ in at most max_distance chunks, so at least one chunk is equal (pigeonhole):
+    pairs that share a chunk value are the only candidates
+    """
+    bounds = np.linspace(0, 64, min(max_distance + 1, 64) + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class ImageHashIndex:
+    """
+    pHash of every image file, stored on disk (cache_dir/image_hashes) and keyed by path and mtime:
+    a file is decoded again only when it is new or changed. decode_size is passed to image_phash,
+    hashes of full decoding (decode_size=None) are stored apart in cache_dir/image_hashes_full.
+    Table columns: Path, Code (file name without extension, the product code of the scraped images),
+    Mtime (ns) and Hash (64 bit pHash as uint64).
+    Files that can not be decoded are kept in failures (Path, Mtime, Error, stored next to the table
+    with the suffix _errors), so they are not decoded again until they change.
+
+        index = ImageHashIndex()
+        errors = index.add_folder("/home/viktoria/Downloads/images")
+        pairs = index.pairs_within(4)
+        similar = index.nearest("12596")
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, decode_size=HASH_DECODE_SIZE):
+        self.decode_size = decode_size
+        name = {HASH_DECODE_SIZE: 'image_hashes', None: 'image_hashes_full'}.get(decode_size,
+                                                                                 f'image_hashes_{decode_size}')
+        self.path = os.path.join(cache_dir, name) if cache_dir else None
+        table = load_frame(self.path) if self.path else None
+        if table is None:
+            table = pd.DataFrame({'Path': pd.Series(dtype=object), 'Code': pd.Series(dtype=object),
+                                  'Mtime': pd.Series(dtype=np.int64), 'Hash': pd.Series(dtype=np.uint64)})
+        failures = load_frame(self.path + '_errors') if self.path else None
+        if failures is None:
+            failures = pd.DataFrame({'Path': pd.Series(dtype=object), 'Mtime': pd.Series(dtype=np.int64),
+                                     'Error': pd.Series(dtype=object)})
+        self.table = table
+        self.failures = failures
+
+    def __len__(self):
+        return len(self.table)
+
+    def update(self, paths, workers=1):
+        """
+        Hashes the paths that are new or changed since they were indexed (see hash_images) and saves the index.
+        Returns errors ({path: message}) for the paths without a hash, nothing is printed: files that can not
+        be read (removed from the index) and files that can not be decoded, remembered by path and mtime
+        """
+        paths = [os.path.abspath(path) for path in paths]
+        known = dict(zip(self.table['Path'], self.table['Mtime']))
+        failed = dict(zip(self.failures['Path'], self.failures['Mtime']))
+        mtimes, errors = {}, {}
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError as e:
+                errors[path] = f"{type(e).__name__}: {e}"
+        stale = [path for path, mtime in mtimes.items() if known.get(path) != mtime and failed.get(path) != mtime]
+        remembered = dict(zip(self.failures['Path'], self.failures['Error']))
+        errors.update({path: remembered[path] for path, mtime in mtimes.items() if failed.get(path) == mtime})
+        if not stale and len(mtimes) == len(paths):
+            return errors
+
+        hashes, new_errors = hash_images(stale, workers, self.decode_size)
+        errors.update(new_errors)
+        rows = [{'Path': path, 'Code': os.path.splitext(os.path.basename(path))[0], 'Mtime': mtimes[path],
+                 'Hash': value} for path, value in hashes.items()]
+
+        dropped = set(stale) | (set(paths) - set(mtimes))
+        kept = self.table[~self.table['Path'].isin(dropped)]
+        new = pd.DataFrame(rows, columns=kept.columns).astype(kept.dtypes.to_dict())
+        self.table = pd.concat([kept, new], ignore_index=True) if len(new) else kept.reset_index(drop=True)
+
+        kept = self.failures[~self.failures['Path'].isin(dropped)]
+        new = pd.DataFrame([{'Path': path, 'Mtime': mtimes[path], 'Error': error} for path, error in new_errors.items()],
+                           columns=kept.columns).astype(kept.dtypes.to_dict())
+        self.failures = pd.concat([kept, new], ignore_index=True) if len(new) else kept.reset_index(drop=True)
+        self.save()
+        return errors
+
+    def add_folder(self, folder, extensions=IMAGE_EXTENSIONS, workers=1):
+        """update with every image file of the folder, returns its errors"""
+        paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                 if name.lower().endswith(extensions)]
+        return self.update(paths, workers)
+
+    def save(self):
+        if self.path:
+            save_frame(self.table, self.path)
+            save_frame(self.failures, self.path + '_errors')
+
+    def hashes(self):
+        return self.table['Hash'].to_numpy(dtype=np.uint64)
+
+    def pairs_within(self, max_distance=4):
+        """
+        Every pair of indexed images with Hamming distance <= max_distance, as a frame with
+        Path 1, Code 1, Path 2, Code 2 and Distance, closest first.
+        Multi-index hashing: only pairs that share one of the max_distance + 1 chunks of the hash
+        (see hash_chunks) are compared, instead of every pair of images
+        """
+        hashes = self.hashes()
+        positions = np.arange(len(hashes))
+        found_i, found_j = [], []
+        for low, high in hash_chunks(max_distance):
+            mask = np.uint64((1 << int(high - low)) - 1)
+            chunk_codes, _ = pd.factorize((hashes >> np.uint64(low)) & mask)
+            pos_i, pos_j = group_pairs(chunk_codes, positions)
+            close = hamming_distances(hashes[pos_i], hashes[pos_j]) <= max_distance
+            found_i.append(pos_i[close])
+            found_j.append(pos_j[close])
+
+        # a pair found by several chunks is kept once
+        n = max(len(hashes), 1)
+        pair_ids = np.unique(np.concatenate(found_i) * n + np.concatenate(found_j))
+        pos_i, pos_j = pair_ids // n, pair_ids % n
+        distances = hamming_distances(hashes[pos_i], hashes[pos_j])
+        order = np.argsort(distances, kind='stable')
+        pos_i, pos_j = pos_i[order], pos_j[order]
+        return pd.DataFrame({
+            'Path 1': self.table['Path'].to_numpy()[pos_i], 'Code 1': self.table['Code'].to_numpy()[pos_i],
+            'Path 2': self.table['Path'].to_numpy()[pos_j], 'Code 2': self.table['Code'].to_numpy()[pos_j],
+            'Distance': distances[order],
+        })
+
+    def nearest(self, image, n=5, max_distance=None):
+        """
+        The n indexed images closest to image (an indexed product code or path, or an image file),
+        as a frame with Path, Code and Distance. The image itself is not included
+        """
+        table = self.table
+        matches = table[(table['Code'] == str(image)) | (table['Path'] == os.path.abspath(str(image)))]
+        if len(matches):
+            value, path = matches['Hash'].iloc[0], matches['Path'].iloc[0]
+        else:
+            value, path = image_phash(image, self.decode_size), os.path.abspath(str(image))
+
+        distances = hamming_distances(self.hashes(), value)
+        result = table[['Path', 'Code']].assign(Distance=distances)
+        result = result[result['Path'] != path]
+        if max_distance is not None:
+            result = result[result['Distance'] <= max_distance]
+        return result.sort_values('Distance', kind='stable').head(n).reset_index(drop=True)
+
+
 if __name__ == "__main__":
     path1 = "/home/viktoria/Downloads/images/89295.png"
     path2 = "/home/viktoria/Downloads/images/12596.png"
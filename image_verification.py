@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import DEFAULT_CACHE_DIR
+from image_processing import ImageHashIndex, hamming_distances
+from utils import PAIR_COLUMNS, process_excel_for_duplicates
+from web_srapping import resolve_product_urls, download_images
+
+
+def sku_code(sku):
+    """Product code of a SKU as text (12596.0 -> "12596"), None for a missing SKU"""
+    if pd.isna(sku):
+        return None
+    if isinstance(sku, (float, np.floating)) and float(sku).is_integer():
+        return str(int(sku))
+    return str(sku).strip()
+
+
+def review_codes(pairs):
+    """Product codes of both sides of a pair table, each once"""
+    skus = pd.concat([pairs['SKU 1'], pairs['SKU 2']], ignore_index=True).drop_duplicates()
+    return [code for code in dict.fromkeys(sku_code(sku) for sku in skus) if code]
+
+
+def fetch_review_images(codes, image_folder, backend_factory=None, workers=2, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Makes sure image_folder has <code>.png for the codes: codes without an image are looked up
+    with resolve_product_urls and downloaded with download_images (both cached across runs).
+    Without backend_factory only the images already in the folder are used
+    """
+    missing = [code for code in codes if not os.path.exists(os.path.join(image_folder, f"{code}.png"))]
+    if not missing or backend_factory is None:
+        return
+    urls = resolve_product_urls(missing, backend_factory, workers, cache_dir)
+    found = urls.dropna(subset=["URL"])
+    download_images(zip(found["Code"], found["URL"]), image_folder, os.path.join(cache_dir, "images"))
+
+
+def add_image_distance(pairs, image_folder, backend_factory=None, workers=2, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Copy of pairs with Image Distance: Hamming distance between the pHash of the product images
+    of both SKUs (<NA> when an image is missing). Only the SKUs of pairs are fetched and hashed,
+    and the hash of every image is kept in the ImageHashIndex of cache_dir, so the cost follows the
+    number of pairs to review, not the size of the catalog, and a SKU is hashed once across runs.
+    Images are decoded in full, the distances are the ones of is_same_product_image and its threshold applies.
+    Without pairs (process_excel_for_duplicates returns a frame without columns) the result is an empty
+    pair table with an empty Image Distance
+    """
+    if pairs.empty:
+        result = pd.DataFrame(columns=list(pairs.columns) or PAIR_COLUMNS)
+        result['Image Distance'] = pd.array([], dtype='Int64')
+        return result
+
+    codes = review_codes(pairs)
+    fetch_review_images(codes, image_folder, backend_factory, workers, cache_dir)
+
+    paths = [os.path.abspath(os.path.join(image_folder, f"{code}.png")) for code in codes]
+    paths = [path for path in paths if os.path.exists(path)]
+    index = ImageHashIndex(cache_dir, decode_size=None)
+    # images that can not be decoded have no hash, their pairs get no distance
+    index.update(paths)
+    table = index.table
+    table = table[table['Path'].isin(paths)]
+    hashes = dict(zip(table['Code'], table['Hash']))
+
+    def pair_hashes(column):
+        values = [hashes.get(sku_code(sku)) for sku in pairs[column]]
+        found = np.array([value is not None for value in values], dtype=bool)
+        return np.array([value if value is not None else 0 for value in values], dtype=np.uint64), found
+
+    hashes1, found1 = pair_hashes('SKU 1')
+    hashes2, found2 = pair_hashes('SKU 2')
+    distances = pd.array(hamming_distances(hashes1, hashes2), dtype='Int64')
+    distances[~(found1 & found2)] = pd.NA
+
+    result = pairs.copy()
+    result['Image Distance'] = distances
+    return result
+
+
+def process_excel_with_image_check(excel_path, image_folder, backend_factory=None, confidence_threshold=93,
+                                   low_confidence_threshold=90, workers=2, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    process_excel_for_duplicates plus the image check of the pairs that need review:
+    returns confident_df and needs_review_df with Image Distance (see add_image_distance)
+    """
+    confident, needs_review = process_excel_for_duplicates(excel_path, confidence_threshold, low_confidence_threshold)
+    return confident, add_image_distance(needs_review, image_folder, backend_factory, workers, cache_dir)
@@ -0,0 +1,121 @@
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+# per brand counters, in the order of the profile table
+BRAND_COUNTERS = ['Pairs Generated', 'Same Sheet', 'SKU Relation', 'Number Mismatch', 'Score Bound',
+                  'Below Threshold', 'Accepted', 'Flavor Variants', 'Near SKU']
+
+# stats of the run inside collect_stats, None when instrumentation is off
+_active = None
+
+
+class PipelineStats:
+    """
+    Wall time, peak memory (the highest memory traced by tracemalloc while the stage ran)
+    and number of calls of every stage, plus pair counters per brand:
+    pairs generated (every pair of rows of the brand), skipped because both rows are in the same sheet,
+    rejected by the SKU relation, rejected by a number mismatch, skipped by the score bound (length or index),
+    scored below the threshold, accepted, flavor variants and near SKU pairs (different SKUs at most 3 apart).
+    Pairs Generated is the sum of the counters from Same Sheet to Accepted.
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = defaultdict(lambda: {'Calls': 0, 'Seconds': 0.0, 'Peak MB': 0.0})
+        self.brands = defaultdict(Counter)
+        # running memory peaks of the open stages, nested stages reset the tracemalloc peak
+        self._peaks = []
+
+    @contextmanager
+    def stage(self, name):
+        """Adds the wall time and peak memory of the block to the stage name"""
+        if self.trace_memory:
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            record = self.stages[name]
+            record['Calls'] += 1
+            record['Seconds'] += seconds
+            if self.trace_memory:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                record['Peak MB'] = max(record['Peak MB'], peak / 2 ** 20)
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+
+    def count(self, marca, counts):
+        """Adds counts ({counter: number}) to the counters of a brand"""
+        brand = self.brands[marca]
+        for counter, value in counts.items():
+            brand[counter] += int(value)
+
+    def stage_table(self):
+        """One row per stage, in the order the stages first ran"""
+        table = pd.DataFrame([{'Stage': name, **record} for name, record in self.stages.items()],
+                             columns=['Stage', 'Calls', 'Seconds', 'Peak MB'])
+        if not self.trace_memory:
+            table['Peak MB'] = float('nan')
+        return table.round({'Seconds': 4, 'Peak MB': 2})
+
+    def profile(self):
+        """Per brand profile table with the BRAND_COUNTERS, brands with the most generated pairs first"""
+        table = pd.DataFrame([{'Marca': marca, **{counter: counts[counter] for counter in BRAND_COUNTERS}}
+                              for marca, counts in self.brands.items()], columns=['Marca'] + BRAND_COUNTERS)
+        return table.sort_values('Pairs Generated', ascending=False, kind='stable').reset_index(drop=True)
+
+    def to_dict(self):
+        """Stages and brand counters as plain dicts, ready for json.dump"""
+        return {
+            'stages': {name: dict(record) for name, record in self.stages.items()},
+            'brands': {str(marca): dict(counts) for marca, counts in self.brands.items()},
+        }
+
+
+@contextmanager
+def collect_stats(trace_memory=True):
+    """
+    Turns instrumentation on for the block and yields its PipelineStats:
+
+        with collect_stats() as stats:
+            process_excel_for_duplicates(path)
+        print(stats.stage_table())
+
+    trace_memory uses tracemalloc for the peak memory of each stage, it makes the run slower
+    """
+    global _active
+    stats = PipelineStats(trace_memory)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    previous, _active = _active, stats
+    try:
+        yield stats
+    finally:
+        _active = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def active_stats():
+    """PipelineStats of the current collect_stats block, None when instrumentation is off"""
+    return _active
+
+
+def stage(name):
+    """Context manager that times the block as stage name, does nothing when instrumentation is off"""
+    return _active.stage(name) if _active is not None else nullcontext()
+
+
+def count(marca, counts):
+    """Adds counts to the brand counters, does nothing when instrumentation is off"""
+    if _active is not None:
+        _active.count(marca, counts)
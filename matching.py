@@ -0,0 +1,455 @@
+import numpy as np
+import pandas as pd
+from fuzzywuzzy.utils import full_process
+from rapidfuzz import fuzz, process
+from itertools import combinations
+from collections import defaultdict
+
+from array_utils import group_rows, group_pairs
+
+# rows per side of a scoring tile, a tile score matrix is at most 2048 x 2048 float64 (32 MB)
+TILE_ROWS = 2048
+
+# groups of rows up to this size are scored as explicit pairs, larger ones in tiles
+SMALL_GROUP = 256
+
+# rows probed at once by candidate_pairs
+CANDIDATE_CHUNK = 16
+
+
+def token_sort_key(text):
+    """Preprocessing that fuzz.token_sort_ratio applies to a name before scoring:
+    non-ascii symbols removed, lowercase, tokens sorted.
+    fuzz.ratio of two keys gives the same score as fuzz.token_sort_ratio of the names."""
+    tokens = full_process(text, force_ascii=True).split()
+    return " ".join(sorted(tokens))
+
+
+def score_block(keys_a, keys_b, similarity_threshold, workers=1):
+    """Scores every key of keys_a against every key of keys_b in one cdist call (on workers threads of rapidfuzz).
+    Returns positions (a, b) and the rounded scores of the pairs that reach the threshold"""
+    # fuzzywuzzy rounds half to even, so a raw score of threshold - 0.5 can still reach it
+    cutoff = max(similarity_threshold - 0.5, 0)
+    scores = process.cdist(keys_a, keys_b, scorer=fuzz.ratio, score_cutoff=cutoff, dtype=np.float64,
+                           workers=workers)
+    scores = np.rint(scores)
+    a, b = np.nonzero(scores >= similarity_threshold)
+    return a, b, scores[a, b].astype(np.int64)
+
+
+def qgram_profile(key, q=2):
+    """Multiset of character q-grams of a key. Repeated q-grams are numbered by occurrence,
+    so the size of a set intersection is the multiset overlap"""
+    seen = defaultdict(int)
+    profile = []
+    for k in range(len(key) - q + 1):
+        gram = key[k:k + q]
+        profile.append((gram, seen[gram]))
+        seen[gram] += 1
+    return profile
+
+
+def required_overlap(len1, len2, similarity_threshold, q=2):
+    """
+    Minimum number of shared q-grams two keys need to possibly reach the threshold.
+
+    The score is 100 * 2 * LCS / (len1 + len2), so reaching threshold - 0.5 bounds the
+    indel distance d. Every run of deleted characters breaks at most q - 1 q-grams of the LCS,
+    so the keys share at least LCS - q + 1 - (q - 1) * d q-grams.
+    A result <= 0 means the pair can not be pruned. Works on scalars and arrays.
+    """
+    theta = (similarity_threshold - 0.5) / 100
+    total = np.asarray(len1) + np.asarray(len2)
+    max_distance = (1 - theta) * total
+    min_lcs = theta * total / 2
+    return np.ceil(min_lcs - q + 1 - (q - 1) * max_distance - 1e-9).astype(np.int64)
+
+
+def length_compatible(len1, len2, similarity_threshold):
+    """The score can not be higher than 100 * 2 * min(len1, len2) / (len1 + len2)"""
+    theta = (similarity_threshold - 0.5) / 100
+    total = np.asarray(len1) + np.asarray(len2)
+    return (total == 0) | (2 * np.minimum(len1, len2) >= theta * total - 1e-9)
+
+
+def candidate_pairs(keys, sheets, similarity_threshold, q=2):
+    """
+    Candidate generation for a brand block with an inverted index of character q-grams of the keys.
+
+    Every key indexes only its prefix (rarest q-grams first), the shortest prefix that still
+    guarantees a shared entry with any partner that has enough overlap (prefix filtering).
+    Candidates are then checked with length_compatible and the exact overlap against required_overlap,
+    rows are probed in chunks of CANDIDATE_CHUNK with array operations (no loop per row).
+    Keys too short to be pruned are paired with every other row.
+    The filter is lossless: every cross-sheet pair that can reach the threshold is returned.
+
+    Returns arrays (i, j) with i < j, sorted.
+    """
+    n = len(keys)
+    lengths = np.array([len(key) for key in keys], dtype=np.int64)
+    sheet_codes, _ = pd.factorize(np.asarray(sheets, dtype=object), use_na_sentinel=False)
+
+    vocabulary = {}
+    profiles = []
+    for key in keys:
+        profiles.append([vocabulary.setdefault(gram, len(vocabulary)) for gram in qgram_profile(key, q)])
+
+    # profiles as one flat array, row x owns tokens[starts[x]:starts[x] + sizes[x]]
+    sizes = np.array([len(profile) for profile in profiles], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1])) if n else sizes
+    tokens = np.fromiter((token for profile in profiles for token in profile), dtype=np.int64, count=sizes.sum())
+    rows = np.repeat(np.arange(n), sizes)
+
+    # rarest q-grams first, so prefixes hit short posting lists
+    frequency = np.bincount(tokens, minlength=len(vocabulary))
+    rank = np.empty(len(vocabulary), dtype=np.int64)
+    rank[np.lexsort((np.arange(len(vocabulary)), frequency))] = np.arange(len(vocabulary))
+    order = np.lexsort((rank[tokens], rows))
+    tokens = tokens[order]
+
+    # the shortest partner that passes the length filter gives the smallest required overlap
+    theta = (similarity_threshold - 0.5) / 100
+    shortest_partner = np.ceil(lengths * theta / (2 - theta) - 1e-9).astype(np.int64)
+    needed = required_overlap(lengths, shortest_partner, similarity_threshold, q)
+    loose = needed <= 0
+    prefix_sizes = np.where(loose, sizes, np.clip(sizes - needed + 1, 0, None))
+
+    in_prefix = np.arange(len(tokens)) - np.repeat(starts, sizes) < np.repeat(prefix_sizes, sizes)
+    index_tokens, index_rows = tokens[in_prefix], rows[in_prefix]
+    index_order = np.lexsort((index_rows, index_tokens))
+    index_tokens, index_rows = index_tokens[index_order], index_rows[index_order]
+    # postings sorted by (q-gram, row): the later rows of a posting list start at a searchsorted of this key
+    index_keys = index_tokens * max(n, 1) + index_rows
+    posting_ends = np.searchsorted(index_tokens, np.arange(len(vocabulary)), side='right')
+
+    parts_i, parts_j = [], []
+    # the rows are probed in chunks, every step is vectorized over the pairs of a chunk
+    for first in range(0, n, CANDIDATE_CHUNK):
+        last = min(first + CANDIDATE_CHUNK, n)
+        chunk = np.arange(first, last)
+
+        # partners of the chunk: later rows sharing a prefix q-gram, every later row for a loose row
+        probe = slice(starts[first], starts[last - 1] + sizes[last - 1])
+        probe_rows, probe_tokens = rows[probe], tokens[probe]
+        probing = in_prefix[probe] & ~loose[probe_rows]
+        probe_rows, probe_tokens = probe_rows[probing], probe_tokens[probing]
+        pos_i, pos_j = ranges(probe_rows, np.searchsorted(index_keys, probe_tokens * n + probe_rows + 1),
+                              posting_ends[probe_tokens])
+        loose_rows = chunk[loose[chunk]]
+        seen = np.zeros((last - first, n), dtype=bool)
+        seen[pos_i - first, index_rows[pos_j]] = True
+        seen[loose_rows - first] |= np.arange(n) > loose_rows[:, None]
+        # a pair found through several q-grams is kept once
+        pos_i, pos_j = np.nonzero(seen)
+        pos_i += first
+
+        kept = (sheet_codes[pos_i] != sheet_codes[pos_j]) & length_compatible(lengths[pos_i], lengths[pos_j],
+                                                                             similarity_threshold)
+        pos_i, pos_j = pos_i[kept], pos_j[kept]
+
+        # exact overlap of every pair: the q-grams of j that are in the profile of i
+        member = np.zeros((last - first, len(vocabulary)), dtype=bool)
+        member[rows[probe] - first, tokens[probe]] = True
+        segment, positions = ranges(np.arange(len(pos_j)), starts[pos_j], starts[pos_j] + sizes[pos_j])
+        hits = member[pos_i[segment] - first, tokens[positions]]
+        overlap = np.bincount(segment, weights=hits, minlength=len(pos_j))
+        passed = overlap >= required_overlap(lengths[pos_i], lengths[pos_j], similarity_threshold, q)
+        parts_i.append(pos_i[passed])
+        parts_j.append(pos_j[passed])
+
+    if not parts_i:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty
+
+    return np.concatenate(parts_i), np.concatenate(parts_j)
+
+
+def ranges(owners, starts, ends):
+    """The integers starts[k]..ends[k] - 1 of every k, flattened, with the owner of every integer:
+    returns (owners repeated, integers)"""
+    counts = np.clip(np.asarray(ends, dtype=np.int64) - starts, 0, None)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(owners, counts), np.repeat(starts, counts) + offsets
+
+
+def score_pairs(keys, pos_i, pos_j, similarity_threshold, workers=1):
+    """Scores aligned pairs of keys in one cpdist call (on workers threads of rapidfuzz), same scores as score_block"""
+    cutoff = max(similarity_threshold - 0.5, 0)
+    scores = process.cpdist(keys[pos_i].tolist(), keys[pos_j].tolist(), scorer=fuzz.ratio,
+                            score_cutoff=cutoff, dtype=np.float64, workers=workers)
+    scores = np.rint(scores)
+    passed = scores >= similarity_threshold
+    return pos_i[passed], pos_j[passed], scores[passed].astype(np.int64)
+
+
+def partner_lengths(lengths, similarity_threshold):
+    """Shortest and longest key length that can reach the threshold with keys of the given lengths
+    (the length bound of length_compatible)"""
+    theta = (similarity_threshold - 0.5) / 100
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if theta <= 0:
+        return np.zeros_like(lengths), np.full_like(lengths, np.iinfo(np.int64).max)
+    shortest = np.ceil(lengths * theta / (2 - theta) - 1e-9).astype(np.int64)
+    longest = np.floor(lengths * (2 - theta) / theta + 1e-9).astype(np.int64)
+    return shortest, longest
+
+
+def band_tiles(rows_a, rows_b, lengths, similarity_threshold, tile_rows=TILE_ROWS):
+    """
+    Tiles of the pairs rows_a x rows_b that the length bound can not rule out.
+    Both sides are sorted by key length, every chunk of tile_rows rows of a is only paired with
+    the rows of b inside its length band, split in chunks of tile_rows rows
+    """
+    rows_a = rows_a[np.argsort(lengths[rows_a], kind='stable')]
+    rows_b = rows_b[np.argsort(lengths[rows_b], kind='stable')]
+    lengths_b = lengths[rows_b]
+
+    tiles = []
+    for start_a in range(0, len(rows_a), tile_rows):
+        chunk = rows_a[start_a:start_a + tile_rows]
+        shortest, _ = partner_lengths(lengths[chunk[0]], similarity_threshold)
+        _, longest = partner_lengths(lengths[chunk[-1]], similarity_threshold)
+        first = np.searchsorted(lengths_b, shortest, side='left')
+        last = np.searchsorted(lengths_b, longest, side='right')
+        for start_b in range(first, last, tile_rows):
+            tiles.append((chunk, rows_b[start_b:min(start_b + tile_rows, last)]))
+    return tiles
+
+
+def cross_sheet_pairs(sheets_a, sheets_b=None):
+    """Number of pairs of rows from different sheets, within sheets_a or between sheets_a and sheets_b"""
+    if sheets_b is None:
+        sizes = np.bincount(sheets_a)
+        return int((sizes.sum() ** 2 - (sizes ** 2).sum()) // 2)
+    size = max(sheets_a.max(initial=-1), sheets_b.max(initial=-1)) + 1
+    sizes_a, sizes_b = np.bincount(sheets_a, minlength=size), np.bincount(sheets_b, minlength=size)
+    return int(sizes_a.sum() * sizes_b.sum() - (sizes_a * sizes_b).sum())
+
+
+def cascade_tasks(keys, sheets, similarity_threshold, signatures=None, skus=None, tile_rows=TILE_ROWS, counts=None,
+                  use_index=False):
+    """
+    Scoring tasks of a brand block after the cheap exact filters, cheapest first:
+    pairs of the same sheet are never generated, then the SKU relation (with skus, codes with -1 for
+    a missing SKU, only rows with the same SKU are paired), then the number signatures (rows with the same
+    signature are paired, rows without numbers, signature -1, are paired with every row),
+    then the length bound of the score (see length_compatible). Only the pairs that survive are scored,
+    every dropped pair would fail a later check, so the matches are the same.
+
+    Groups of at most SMALL_GROUP rows are enumerated as explicit pairs, larger ones are split in tiles
+    within the length band (see band_tiles). A task is (rows_a, rows_b, paired): paired tasks score the aligned
+    pairs (rows_a[k], rows_b[k]), the others every pair of rows_a x rows_b.
+    With use_index the large groups left by the filters are not tiled, only the candidates of candidate_pairs
+    within each group are scored as explicit pairs.
+    counts (a dict) receives the pairs dropped by each filter and the number of pairs scored
+    """
+    lengths = np.array([len(key) for key in keys], dtype=np.int64)
+    codes, _ = pd.factorize(np.asarray(sheets, dtype=object), use_na_sentinel=False)
+    signatures = np.full(len(keys), -1, dtype=np.int64) if signatures is None else np.asarray(signatures)
+    tasks = []
+
+    def add_pairs(pos_i, pos_j):
+        # explicit pairs of different sheets, returns how many pass the signature check
+        cross_sheet = codes[pos_i] != codes[pos_j]
+        pos_i, pos_j = pos_i[cross_sheet], pos_j[cross_sheet]
+        signatures_i, signatures_j = signatures[pos_i], signatures[pos_j]
+        compatible = (signatures_i == signatures_j) | (signatures_i < 0) | (signatures_j < 0)
+        pos_i, pos_j = pos_i[compatible], pos_j[compatible]
+        in_band = length_compatible(lengths[pos_i], lengths[pos_j], similarity_threshold)
+        pos_i, pos_j = pos_i[in_band], pos_j[in_band]
+        chunk = tile_rows * tile_rows
+        tasks.extend((pos_i[start:start + chunk], pos_j[start:start + chunk], True)
+                     for start in range(0, len(pos_i), chunk))
+        return len(pos_i) + int((~in_band).sum())
+
+    def add_tiles(rows_a, rows_b=None):
+        # rows_a x rows_b, or the pairs within rows_a, across sheets; returns the number of those pairs
+        sheets_a = codes[rows_a]
+        if rows_b is None:
+            sheet_codes, sheet_values = pd.factorize(sheets_a)
+            groups = [rows_a[group] for group in group_rows(sheet_codes, len(sheet_values))]
+            sides = [(groups[x], groups[y]) for x, y in combinations(range(len(groups)), 2)]
+            pairs = cross_sheet_pairs(sheets_a)
+        else:
+            sides = [(rows_a[sheets_a == sheet], rows_b[codes[rows_b] != sheet]) for sheet in np.unique(sheets_a)]
+            pairs = cross_sheet_pairs(sheets_a, codes[rows_b])
+        if use_index:
+            rows = rows_a if rows_b is None else np.concatenate([rows_a, rows_b])
+            pos_i, pos_j = candidate_pairs(keys[rows], codes[rows], similarity_threshold)
+            if rows_b is not None:
+                # only the pairs of a row of rows_a with a row of rows_b (i < j, rows_a come first)
+                across = (pos_i < len(rows_a)) & (pos_j >= len(rows_a))
+                pos_i, pos_j = pos_i[across], pos_j[across]
+            add_pairs(rows[pos_i], rows[pos_j])
+            return pairs
+        for side_a, side_b in sides:
+            tasks.extend((tile_a, tile_b, False) for tile_a, tile_b in
+                         band_tiles(side_a, side_b, lengths, similarity_threshold, tile_rows))
+        return pairs
+
+    def add_block(rows):
+        # pairs of rows that pass the signature check, returns how many
+        wildcard = rows[signatures[rows] < 0]
+        numbered = rows[signatures[rows] >= 0]
+        signature_codes, _ = pd.factorize(signatures[numbered])
+        small = (np.bincount(signature_codes) <= SMALL_GROUP)[signature_codes]
+        compatible = add_pairs(*group_pairs(signature_codes[small], numbered[small]))
+        large_codes, large_values = pd.factorize(signature_codes[~small])
+        for group in group_rows(large_codes, len(large_values)):
+            compatible += add_tiles(numbered[~small][group])
+        if len(wildcard):
+            compatible += add_tiles(wildcard)
+            if len(numbered):
+                compatible += add_tiles(numbered, wildcard)
+        return compatible
+
+    if skus is None:
+        sku_compatible = cross_sheet_pairs(codes)
+        compatible = add_block(np.arange(len(keys)))
+    else:
+        skus = np.asarray(skus)
+        present = np.flatnonzero(skus >= 0)
+        sku_codes, _ = pd.factorize(skus[present])
+        small = (np.bincount(sku_codes) <= SMALL_GROUP)[sku_codes]
+        pos_i, pos_j = group_pairs(sku_codes[small], present[small])
+        sku_compatible = int((codes[pos_i] != codes[pos_j]).sum())
+        compatible = add_pairs(pos_i, pos_j)
+        large_codes, large_values = pd.factorize(sku_codes[~small])
+        for group in group_rows(large_codes, len(large_values)):
+            group = present[~small][group]
+            sku_compatible += cross_sheet_pairs(codes[group])
+            compatible += add_block(group)
+
+    if counts is not None:
+        scored = sum(len(rows_a) if paired else len(rows_a) * len(rows_b) for rows_a, rows_b, paired in tasks)
+        counts['SKU Relation'] = counts.get('SKU Relation', 0) + cross_sheet_pairs(codes) - sku_compatible
+        counts['Number Mismatch'] = counts.get('Number Mismatch', 0) + sku_compatible - compatible
+        counts['Score Bound'] = counts.get('Score Bound', 0) + compatible - scored
+        counts['Scored'] = counts.get('Scored', 0) + scored
+    return tasks
+
+
+def match_brand(keys, sheets, similarity_threshold, use_index=False, workers=1, tile_rows=TILE_ROWS,
+                signatures=None, skus=None, counts=None):
+    """
+    Finds the pairs of one brand block that reach the threshold.
+    Cheap exact filters run before the score (see cascade_tasks): pairs from the same sheet are never generated,
+    with skus (codes, -1 for a missing SKU) only pairs with the same SKU, with signatures (number signature codes,
+    -1 for names without numbers) only pairs with compatible numbers, and the length bound of the score.
+    With use_index the groups left by those filters are not tiled, only the candidates of candidate_pairs
+    within each group are scored. It finds the same pairs, but is slower than the tiled cdist (see candidate_recall).
+
+    Large groups are scored in tiles, one after the other. workers is passed to rapidfuzz (cdist and cpdist),
+    which splits every call over that many threads in C; the output does not depend on workers.
+
+    keys, sheets, signatures and skus are aligned with the rows of the block.
+    counts (a dict) receives the pairs dropped by each filter and the pairs scored.
+    Returns arrays (i, j, score) with i < j, in the same order as combinations(range(len(keys)), 2)
+    """
+    keys = np.asarray(keys, dtype=object)
+
+    tasks = cascade_tasks(keys, sheets, similarity_threshold, signatures, skus, tile_rows, counts, use_index)
+
+    def score_task(task):
+        rows_a, rows_b, paired = task
+        if paired:
+            return score_pairs(keys, rows_a, rows_b, similarity_threshold, workers)
+        a, b, scores = score_block(keys[rows_a].tolist(), keys[rows_b].tolist(), similarity_threshold, workers)
+        return rows_a[a], rows_b[b], scores
+
+    return merge_pairs(map(score_task, tasks))
+
+
+def match_rows(keys, sheets, rows, similarity_threshold, workers=1, tile_rows=TILE_ROWS):
+    """
+    Pairs of one brand block that involve at least one of rows (positions in the block),
+    for incremental updates. The rows are scored against the whole block, every pair once.
+    Returns the same (i, j, score) arrays as match_brand restricted to those pairs
+    """
+    keys = np.asarray(keys, dtype=object)
+    rows = np.asarray(rows, dtype=np.int64)
+    codes, _ = pd.factorize(np.asarray(sheets, dtype=object), use_na_sentinel=False)
+    selected = np.zeros(len(keys), dtype=bool)
+    selected[rows] = True
+
+    block = np.arange(len(keys))
+    tiles = [(rows[start_a:start_a + tile_rows], block[start_b:start_b + tile_rows])
+             for start_a in range(0, len(rows), tile_rows)
+             for start_b in range(0, len(block), tile_rows)]
+
+    def score_tile(tile):
+        rows_a, rows_b = tile
+        return score_block(keys[rows_a].tolist(), keys[rows_b].tolist(), similarity_threshold, workers)
+
+    def keep(pos_a, pos_b):
+        # no same sheet pairs, and a pair of two selected rows is kept only from its first row
+        return (codes[pos_a] != codes[pos_b]) & ~(selected[pos_b] & (pos_b <= pos_a))
+
+    return merge_tiles(tiles, map(score_tile, tiles), keep)
+
+
+def merge_tiles(tiles, results, keep=None):
+    """Joins the pairs scored in each tile into (i, j, score) arrays with i < j, sorted by (i, j)"""
+    pairs = []
+    for (rows_a, rows_b), (a, b, scores) in zip(tiles, results):
+        pos_a, pos_b = rows_a[a], rows_b[b]
+        if keep is not None:
+            kept = keep(pos_a, pos_b)
+            pos_a, pos_b, scores = pos_a[kept], pos_b[kept], scores[kept]
+        pairs.append((pos_a, pos_b, scores))
+    return merge_pairs(pairs)
+
+
+def merge_pairs(results):
+    """Joins (pos_a, pos_b, score) arrays into (i, j, score) arrays with i < j, sorted by (i, j)"""
+    parts_i, parts_j, parts_score = [], [], []
+    for pos_a, pos_b, scores in results:
+        parts_i.append(np.minimum(pos_a, pos_b))
+        parts_j.append(np.maximum(pos_a, pos_b))
+        parts_score.append(scores)
+
+    if not parts_i:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+
+    pos_i = np.concatenate(parts_i)
+    pos_j = np.concatenate(parts_j)
+    scores = np.concatenate(parts_score)
+    order = np.lexsort((pos_j, pos_i))
+    return pos_i[order], pos_j[order], scores[order]
+
+
+class PairAccumulator:
+    """
+    Accepted pairs of a scan in growable columns: row positions as uint32 and scores as uint8
+    (9 bytes per pair). Capacity doubles when it is full, so appending is amortized O(1).
+    """
+
+    def __init__(self, capacity=1024):
+        self.row_i = np.empty(capacity, dtype=np.uint32)
+        self.row_j = np.empty(capacity, dtype=np.uint32)
+        self.scores = np.empty(capacity, dtype=np.uint8)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, pos_i, pos_j, scores):
+        """Appends aligned arrays of row positions and scores"""
+        end = self.size + len(pos_i)
+        if end > len(self.row_i):
+            capacity = max(end, 2 * len(self.row_i))
+            for name in ['row_i', 'row_j', 'scores']:
+                column = getattr(self, name)
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+
+        self.row_i[self.size:end] = pos_i
+        self.row_j[self.size:end] = pos_j
+        self.scores[self.size:end] = scores
+        self.size = end
+
+    def arrays(self):
+        """(row_i, row_j, scores) of the pairs added so far"""
+        return self.row_i[:self.size], self.row_j[:self.size], self.scores[:self.size]
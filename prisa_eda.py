@@ -0,0 +1,247 @@
+import argparse
+import os
+import time
+
+import pandas as pd
+
+from cache import DEFAULT_CACHE_DIR, file_digest, params_digest
+from company_index import sheet_counts
+from excel_utils import write_sheet, save_products_pairs_to_excel
+from instrumentation import stage
+from utils import load_all_sheets, find_internal_duplicates, scan_pairs, add_pair_flags, MatchResult
+
+REPORT_COLUMNS = ["Duplicates", "Same SKU, same name", "Same SKU, similar name", "Same product, different SKU",
+                  "Unique Products", "Total"]
+
+REPORT_COLORS = {
+    "Company": "D3D3D3",                # Light Gray
+    "Total": "D3D3D3",                  # Light Gray
+    "Duplicates": "A52A2A",            # Brown
+    "Same SKU, same name": "87CEEB",   # Blue
+    "Same SKU, similar name": "9370DB",# Purple
+    "Same product, different SKU": "90EE90", # Green
+    "Unique Products": "FF7F7F"        # Red
+}
+
+REPORT_WIDTHS = {
+    "Company": 30,
+    "Duplicates": 15,
+    "Same SKU, same name": 22,
+    "Same SKU, similar name": 25,
+    "Same product, different SKU": 28,
+    "Unique Products": 18,
+    "Total": 10
+}
+
+
+def catalog_stage(inputs, params):
+    return load_all_sheets(params['workbook'], params['exclude_sheets'], cache_dir=None)
+
+
+def scores_stage(inputs, params):
+    # one scoring pass at the lowest threshold with both SKU relations, every table is a view of it
+    # (a PairTable: row positions and scores, the columns are read from the catalog by the views)
+    return scan_pairs(inputs['catalog'].copy(), params['min_threshold'], different_sku=None,
+                      workers=params['workers'])
+
+
+def flags_stage(inputs, params):
+    # flavor variants and SKU too close flags of every pair
+    return add_pair_flags(inputs['scores'])
+
+
+def match_result(inputs, params):
+    return MatchResult(inputs['catalog'], params['min_threshold'], pairs=inputs['flags'])
+
+
+def same_sku_stage(inputs, params):
+    exact, partial = match_result(inputs, params).same_sku_matches(params['same_sku_threshold'])
+    return {'exact': exact, 'partial': partial}
+
+
+def different_sku_stage(inputs, params):
+    confident, needs_review = match_result(inputs, params).different_sku_matches(
+        params['confidence_threshold'], params['low_confidence_threshold'])
+    return {'confident': confident, 'needs_review': needs_review}
+
+
+def unique_stage(inputs, params):
+    return match_result(inputs, params).unique_products(params['confidence_threshold'],
+                                                        params['low_confidence_threshold'],
+                                                        params['same_sku_threshold'])
+
+
+def duplicates_stage(inputs, params):
+    catalog = inputs['catalog'].drop_duplicates(["Marca", "Nombre SKU", "SKU", "Sheet"])
+    return find_internal_duplicates(catalog)
+
+
+def counts_stage(inputs, params):
+    """Products of every table per company (the columns of the report), plus Total.
+    The products of the pair tables are read from the long format of the pairs, built once (MatchResult.store)"""
+    excluded = params['report_exclude']
+    result = match_result(inputs, params)
+    exact, partial = result.same_sku_stores(params['same_sku_threshold'])
+    confident, needs_review = result.different_sku_stores(params['confidence_threshold'],
+                                                          params['low_confidence_threshold'])
+
+    all_different_sku = pd.concat([confident.products(), needs_review.products()])
+    all_different_sku = all_different_sku.drop_duplicates(["Nombre SKU", "Marca", "SKU"])
+    unique = inputs['unique'].drop_duplicates()
+
+    counts = {
+        "Duplicates": sheet_counts(inputs['duplicates']['Sheet'], excluded),
+        "Same SKU, same name": exact.products_per_sheet(),
+        "Same SKU, similar name": partial.products_per_sheet(),
+        "Same product, different SKU": sheet_counts(all_different_sku['Sheet'], excluded),
+        "Unique Products": sheet_counts(unique['Sheet'], excluded),
+    }
+    total = {}
+    for name in ["Same SKU, same name", "Same SKU, similar name", "Duplicates", "Same product, different SKU",
+                 "Unique Products"]:
+        for sheet, n in counts[name].items():
+            total[sheet] = total.get(sheet, 0) + n
+    counts["Total"] = total
+
+    table = pd.DataFrame([counts[name] for name in REPORT_COLUMNS], index=REPORT_COLUMNS).T.fillna(0).astype(int)
+    table.index.name = "Company"
+    return table.reset_index()
+
+
+# stage: (version, stages it reads, parameters of its key, function(inputs, params) -> artifact)
+# the version is part of the key: change it when the code of a stage (or what it calls) changes its artifact
+STAGES = {
+    'catalog': ('1', [], ['workbook', 'exclude_sheets'], catalog_stage),
+    'scores': ('2', ['catalog'], ['min_threshold'], scores_stage),
+    'flags': ('2', ['scores'], [], flags_stage),
+    'same_sku': ('1', ['catalog', 'flags'], ['min_threshold', 'same_sku_threshold'], same_sku_stage),
+    'different_sku': ('1', ['catalog', 'flags'], ['min_threshold', 'confidence_threshold',
+                                                  'low_confidence_threshold'], different_sku_stage),
+    'unique': ('1', ['catalog', 'flags'], ['min_threshold', 'confidence_threshold', 'low_confidence_threshold',
+                                           'same_sku_threshold'], unique_stage),
+    'duplicates': ('1', ['catalog'], [], duplicates_stage),
+    'counts': ('1', ['catalog', 'flags', 'unique', 'duplicates'], ['min_threshold', 'same_sku_threshold',
+                                                                   'confidence_threshold', 'low_confidence_threshold',
+                                                                   'report_exclude'], counts_stage),
+}
+
+
+class StageRunner:
+    """
+    Runs the stages of STAGES on demand, each at most once per run. The artifact of every stage is stored
+    in cache_dir/stages under a key made of its version, its parameters and the keys of the stages it reads
+    (the workbook is keyed by its content), so a later run with other parameters only runs the stages
+    whose key changed and the stages after them. force runs every stage again
+    """
+
+    def __init__(self, params, cache_dir=DEFAULT_CACHE_DIR, force=False):
+        self.params = params
+        self.cache_dir = cache_dir
+        self.force = force
+        self.keys = {}
+        self.artifacts = {}
+        self.ran = []
+
+    def key(self, name):
+        if name not in self.keys:
+            version, inputs, param_names, _ = STAGES[name]
+            values = [file_digest(self.params[p]) if p == 'workbook' else self.params[p] for p in param_names]
+            self.keys[name] = params_digest(name, version, values, [self.key(dep) for dep in inputs])
+        return self.keys[name]
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, 'stages', f"{name}-{self.key(name)}.pkl") if self.cache_dir else None
+
+    def get(self, name):
+        """Artifact of a stage: from this run, from the stage cache or computed"""
+        if name in self.artifacts:
+            return self.artifacts[name]
+
+        path = self.path(name)
+        if path and not self.force and os.path.exists(path):
+            artifact = pd.read_pickle(path)
+            print(f"{name:<14} cached")
+        else:
+            _, inputs, _, function = STAGES[name]
+            artifact_inputs = {dep: self.get(dep) for dep in inputs}
+            start = time.perf_counter()
+            with stage(name):
+                artifact = function(artifact_inputs, self.params)
+            print(f"{name:<14} {time.perf_counter() - start:8.2f} s")
+            self.ran.append(name)
+            if path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                pd.to_pickle(artifact, path + '.tmp')
+                os.replace(path + '.tmp', path)
+        self.artifacts[name] = artifact
+        return artifact
+
+
+def write_report(table, output, output_format):
+    """Company report as xlsx (colors, widths, frozen header) or csv"""
+    if output_format == "csv":
+        table.to_csv(output, index=False)
+    else:
+        write_sheet(output, [(table, None)], column_colors=REPORT_COLORS, column_widths=REPORT_WIDTHS,
+                    default_width=15, freeze_panes="B2", bold_header=True)
+    print(f"Report saved as '{output}'")
+
+
+def run(params, output="Products for each company.xlsx", output_format=None, pairs_output=None,
+        cache_dir=DEFAULT_CACHE_DIR, force=False):
+    """Company report of the workbook in params, the pair tables too with pairs_output. Returns the StageRunner"""
+    runner = StageRunner(params, cache_dir, force)
+    output_format = output_format or ("csv" if output.lower().endswith(".csv") else "xlsx")
+
+    table = runner.get('counts')
+    print(table.set_index("Company")["Total"].to_dict())
+    write_report(table, output, output_format)
+
+    if pairs_output:
+        same_sku, different_sku = runner.get('same_sku'), runner.get('different_sku')
+        save_products_pairs_to_excel(same_sku['exact'], same_sku['partial'], different_sku['confident'],
+                                     different_sku['needs_review'],
+                                     runner.get('unique').rename(columns={"Sheet": "Subempresa"}).drop_duplicates(),
+                                     output_file=pairs_output)
+    return runner
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="prisa-eda",
+                                     description="Duplicate products report per company of a catalog workbook")
+    parser.add_argument("workbook", help="Excel workbook with one sheet per company")
+    parser.add_argument("--output", default="Products for each company.xlsx")
+    parser.add_argument("--format", choices=["xlsx", "csv"], help="format of the report, by default from --output")
+    parser.add_argument("--pairs-output", help="also write the pair tables to this workbook")
+    parser.add_argument("--min-threshold", type=int, default=77, help="lowest similarity scored")
+    parser.add_argument("--same-sku-threshold", type=int, default=88)
+    parser.add_argument("--confidence-threshold", type=int, default=93)
+    parser.add_argument("--low-confidence-threshold", type=int, default=77)
+    parser.add_argument("--exclude-sheet", action="append", default=None,
+                        help="sheet that is not read (default: Familia Corporativa)")
+    parser.add_argument("--report-exclude", action="append", default=None,
+                        help="company left out of the report counts (default: Prilogic Arbol_24_25)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--force", action="store_true", help="run every stage again")
+    args = parser.parse_args(argv)
+
+    for name in ["same_sku_threshold", "confidence_threshold", "low_confidence_threshold"]:
+        if getattr(args, name) < args.min_threshold:
+            parser.error(f"--{name.replace('_', '-')} is below --min-threshold")
+
+    params = {
+        'workbook': args.workbook,
+        'exclude_sheets': sorted(args.exclude_sheet or ['Familia Corporativa']),
+        'min_threshold': args.min_threshold,
+        'same_sku_threshold': args.same_sku_threshold,
+        'confidence_threshold': args.confidence_threshold,
+        'low_confidence_threshold': args.low_confidence_threshold,
+        'report_exclude': sorted(args.report_exclude or ["Prilogic Arbol_24_25"]),
+        'workers': args.workers,
+    }
+    return run(params, args.output, args.format, args.pairs_output, args.cache_dir, args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# unit spellings of the catalogs and their base unit with the factor to it
+UNITS = {
+    'ML': ('ml', 1), 'CC': ('ml', 1), 'CM3': ('ml', 1),
+    'L': ('ml', 1000), 'LT': ('ml', 1000), 'LTS': ('ml', 1000), 'LITRO': ('ml', 1000), 'LITROS': ('ml', 1000),
+    'MG': ('g', 0.001), 'G': ('g', 1), 'GR': ('g', 1), 'GRS': ('g', 1), 'GRAMO': ('g', 1), 'GRAMOS': ('g', 1),
+    'KG': ('g', 1000), 'KGS': ('g', 1000), 'KILO': ('g', 1000), 'KILOS': ('g', 1000),
+    'U': ('un', 1), 'UN': ('un', 1), 'UND': ('un', 1), 'UNID': ('un', 1), 'UDS': ('un', 1), 'UD': ('un', 1),
+    'UNIDAD': ('un', 1), 'UNIDADES': ('un', 1),
+}
+
+# a number: with points between groups of three digits (thousands, "1.000"), decimal with point or comma,
+# or a fraction like 1/2
+NUMBER = (r'(?<![\d.,/])(?P<number>[1-9]\d{0,2}(?:\.\d{3})+(?![\d.,])|\d+(?:[.,]\d+)?)'
+          r'(?:\s*/\s*(?P<denominator>\d+))?')
+NUMBER_PATTERN = re.compile(NUMBER)
+THOUSANDS_PATTERN = re.compile(r'[1-9]\d{0,2}(?:\.\d{3})+')
+
+# text in parentheses is not part of the name, as in extract_good_numbers
+PARENTHESES_PATTERN = re.compile(r'\([^)]*\)')
+
+# a number followed by a unit that is not the start of a word (\w is unicode, "2 LÁMINAS" has no unit)
+QUANTITY_PATTERN = re.compile(
+    NUMBER + r'\s*(?P<unit>' + '|'.join(sorted(UNITS, key=len, reverse=True)) + r')(?!\w)'
+)
+
+
+def match_amounts(matches):
+    """Values of the numbers of an extractall of NUMBER, thousands points removed and fractions divided"""
+    numbers = matches['number']
+    numbers = numbers.where(~numbers.str.fullmatch(THOUSANDS_PATTERN), numbers.str.replace('.', '', regex=False))
+    amounts = numbers.str.replace(',', '.', regex=False).astype(float)
+    denominators = matches['denominator'].astype(float)
+    return amounts.where(denominators.isna() | (denominators == 0), amounts / denominators)
+
+
+def quantity_keys(names):
+    """
+    Canonical quantity key of every name: the sorted tuple of its (amount, base unit) quantities, amounts in
+    ml, g or units. "500 ML" and "500 CC" give ((500.0, 'ml'),), "1 KG" and "1000 G" give ((1000.0, 'g'),),
+    "1/2 KG" gives ((500.0, 'g'),). Numbers without a unit are kept in the key as (number, ''), so
+    "JUGO 1 L 6 PACK" gives ((1000.0, 'ml'), (6.0, '')) and does not match "JUGO 1 L": two names with the same key
+    have the same numbers up to the units. Names without numbers get None.
+    Text in parentheses is dropped, as in extract_good_numbers: "YOGHURT 120 G (1)" gives ((120.0, 'g'),).
+    A point followed by groups of three digits is a thousands separator, "1.000 G" gives ((1000.0, 'g'),),
+    so a decimal written with three digits ("1.500 L" for a litre and a half) is read as thousands too.
+    Works over the whole column at once with the compiled QUANTITY_PATTERN and NUMBER_PATTERN.
+    """
+    names = pd.Series(np.asarray(names, dtype=object)).astype(object)
+    text = names.where(names.map(lambda name: isinstance(name, str)), '').str.upper()
+    text = text.str.replace(PARENTHESES_PATTERN, '', regex=True)
+    matches = text.str.extractall(QUANTITY_PATTERN)
+    # numbers left once the quantities are taken out
+    leftovers = text.str.replace(QUANTITY_PATTERN, ' ', regex=True).str.extractall(NUMBER_PATTERN)
+
+    keys = pd.Series([None] * len(names), dtype=object)
+    if matches.empty and leftovers.empty:
+        return keys
+
+    bases = matches['unit'].map(lambda unit: UNITS[unit][0])
+    factors = matches['unit'].map(lambda unit: UNITS[unit][1]).astype(float)
+    amounts = (match_amounts(matches) * factors).round(6)
+
+    quantities = pd.concat([pd.Series(list(zip(amounts, bases)), index=matches.index, dtype=object),
+                            pd.Series([(amount, '') for amount in match_amounts(leftovers).round(6)],
+                                      index=leftovers.index, dtype=object)])
+    grouped = quantities.groupby(level=0).agg(lambda values: tuple(sorted(set(values))))
+    keys.iloc[grouped.index.to_numpy()] = grouped.to_numpy()
+    return keys
@@ -1,11 +1,21 @@
 import pandas as pd
 import re
-from fuzzywuzzy import fuzz
 from difflib import SequenceMatcher
 from Levenshtein import distance as levenshtein_distance
 from collections import defaultdict
-import networkx as nx
 from itertools import combinations
+import numpy as np
+import time
+import os
+import json
+from catalog import compact_catalog, is_compact, column_codes, take_values
+from array_utils import group_rows
+from instrumentation import stage, count, active_stats
+from cache import file_digest, params_digest, save_frame, load_frame
+from grouping import group_products, group_distribution
+from company_index import CompanyPairs, PairStore
+from quantities import quantity_keys
+from matching import token_sort_key, match_brand, match_rows, candidate_pairs, PairAccumulator
 
 
 def normalize_text(text):
@@ -16,7 +26,30 @@ def normalize_text(text):
     return text
 
 
-def load_all_sheets(path, exclude_sheets=['Familia Corporativa']):
+# part of the cache key of load_all_sheets, increase it when parse_all_sheets returns other frames
+SHEETS_CACHE_VERSION = 1
+
+
+def load_all_sheets(path, exclude_sheets=['Familia Corporativa'], cache_dir=None, compact=False):
+    """Marca, Nombre SKU, SKU and Sheet of every sheet of the workbook.
+    With cache_dir (for example cache.DEFAULT_CACHE_DIR) the result is cached there under the content hash
+    of the workbook, exclude_sheets and SHEETS_CACHE_VERSION, so a changed workbook is parsed again.
+    compact=True returns the compact catalog (see catalog.compact_catalog)"""
+    if cache_dir is not None:
+        key = params_digest(file_digest(path), sorted(exclude_sheets), SHEETS_CACHE_VERSION)
+        cache_path = os.path.join(cache_dir, 'sheets', key)
+        cached = load_frame(cache_path)
+        if cached is not None:
+            return compact_catalog(cached) if compact else cached
+
+    with stage('parse sheets'):
+        df_all = parse_all_sheets(path, exclude_sheets)
+    if cache_dir is not None:
+        save_frame(df_all, cache_path)
+    return compact_catalog(df_all) if compact else df_all
+
+
+def parse_all_sheets(path, exclude_sheets):
     xls = pd.ExcelFile(path)
     df_all = []
     for sheet in xls.sheet_names:
@@ -55,90 +88,403 @@ def extract_good_numbers(text):
     return all_numbers
 
 
+FLAVOR_EXCEPTIONS = {"ajo", "té", "sal", "pic", "lim", "ají"}
+
+# Replace common special symbols with letter approximations
+SYMBOL_REPLACEMENTS = {
+    "¥": "n",  # like in word pina, which was written incorrectly with that symbol
+    "$": "s",
+    "€": "e",
+}
+
+
+def split_flavor_tokens(text, min_len=4):
+    """Long (>= min_len letters) and short words of a name, digits are ignored"""
+    for symbol, replacement in SYMBOL_REPLACEMENTS.items():
+        text = text.replace(symbol, replacement)
+    words = re.findall(r'\b[\wÀ-ÿ]+\b', text.lower())
+
+    long_words = {w for w in words if len(w) >= min_len and not w.isdigit()}
+    short_words = {w for w in words if 0 < len(w) < min_len and not w.isdigit()}
+    return long_words, short_words
+
+
+def build_feature_table(names, min_len=4):
+    """
+    Text features of the names, computed once per unique name instead of once per pair.
+    Returns (ids, features): features has one row per unique name and ids[k] is the row of names[k].
+
+    Columns: Nombre SKU, Norm Name, Key (token sorted name used by the scorer), Numbers,
+    Quantity (canonical quantity key, see quantities.quantity_keys),
+    Flavor Tokens (long words plus short flavor exceptions) and Short Tokens.
+    Categorical names are read once per category
+    """
+    ids, uniques = column_codes(names)
+
+    norm_names = [normalize_text(name) for name in uniques]
+    flavor_tokens, short_tokens = [], []
+    for name in uniques:
+        long_words, short_words = split_flavor_tokens(name, min_len)
+        flavor_tokens.append(frozenset(long_words | {w for w in short_words if w in FLAVOR_EXCEPTIONS}))
+        short_tokens.append(frozenset(short_words))
+
+    features = pd.DataFrame({
+        'Nombre SKU': pd.Series(uniques, dtype=object),
+        'Norm Name': pd.Series(norm_names, dtype=object),
+        'Key': pd.Series([token_sort_key(name) for name in norm_names], dtype=object),
+        'Numbers': pd.Series([extract_good_numbers(name) for name in uniques], dtype=object),
+        'Quantity': quantity_keys(uniques),
+        'Flavor Tokens': pd.Series(flavor_tokens, dtype=object),
+        'Short Tokens': pd.Series(short_tokens, dtype=object),
+    })
+    return ids, features
+
+
 def find_internal_duplicates(df):
     """
     Finds products from the same subempresa with the same SKU and Nombre SKU.
     """
     duplicates = (
-        df.groupby(['Sheet', 'SKU', 'Nombre SKU'])
+        df.groupby(['Sheet', 'SKU', 'Nombre SKU'], observed=True)
         .filter(lambda x: len(x) > 1)
         .sort_values(['Sheet', 'SKU'])
     )
     return duplicates.reset_index(drop=True)
 
 
-def find_similar_products(df, similarity_threshold=90, different_sku=True):
-    """different_sku = true -- if we find similar products with different skus
-    if false find with the same sku"""
-    df['Norm Name'] = df['Nombre SKU'].apply(normalize_text)
-    df['Marca'] = df['Marca'].str.strip().str.upper()
-
-    similar_groups = []
-
-    for marca in df['Marca'].unique():
-        sub_df = df[df['Marca'] == marca]
-
-        for i, j in combinations(range(len(sub_df)), 2):
-            row_i = sub_df.iloc[i]
-            row_j = sub_df.iloc[j]
+PAIR_COLUMNS = ['Marca', 'Nombre SKU 1', 'SKU 1', 'Sheet 1', 'Nombre SKU 2', 'SKU 2', 'Sheet 2', 'Similarity',
+                'Numbers 1', 'Numbers 2']
 
-            if row_i['Sheet'] == row_j['Sheet']:
-                continue
 
-            name1 = row_i['Norm Name']
-            name2 = row_j['Norm Name']
-            sim = fuzz.token_sort_ratio(name1, name2)
-
-            condition = row_i['SKU'] != row_j['SKU'] if different_sku else row_i['SKU'] == row_j['SKU']
-
-            if sim >= similarity_threshold and condition:
-                nums1 = extract_good_numbers(row_i['Nombre SKU'])
-
-                nums2 = extract_good_numbers(row_j['Nombre SKU'])
+def find_similar_products(df, similarity_threshold=90, different_sku=True, index_min_rows=None, workers=1,
+                          quantity_blocking=False):
+    """different_sku = true -- if we find similar products with different skus
+    if false find with the same sku
+    Each brand is scored in batched cdist calls between its sheets (see matching.match_brand).
+    With index_min_rows, brands with at least that many rows only score the candidates of the q-gram index
+    within the blocks of the cheap filters. It finds the same pairs but is slower than the tiled cdist on every
+    brand size measured (see candidate_recall), so it is not recommended.
+    workers > 1 lets rapidfuzz score every block on that many threads, the result is the same as with one worker.
+    quantity_blocking compares names by their canonical quantity (Marca, quantity key) instead of the raw numbers,
+    so "500 ML" matches "500 CC" and "1 KG" matches "1000 G" (see quantities.quantity_keys)"""
+    return find_similar_pairs(df, similarity_threshold, different_sku, index_min_rows, workers,
+                              quantity_blocking).to_frame()
+
+
+def find_similar_pairs(df, similarity_threshold=90, different_sku=True, index_min_rows=None, workers=1,
+                       quantity_blocking=False):
+    """find_similar_products as a PairTable: the same pairs in the same order, columns are read only when asked"""
+    pairs = scan_pairs(df, similarity_threshold, different_sku, index_min_rows, workers, quantity_blocking)
+    scores = pd.DataFrame({'Similarity': pairs.column('Similarity')})
+    return pairs.take(scores.sort_values(by="Similarity", ascending=False).index.to_numpy())
+
+
+def scan_similar_pairs(df, similarity_threshold=90, different_sku=True, index_min_rows=None, workers=1,
+                       with_rows=False, quantity_blocking=False):
+    """Pairs of find_similar_products in the order they are found (brand, then row positions).
+    different_sku = None keeps pairs with both the same and different SKU,
+    with_rows adds the positions of both rows in df (Row 1, Row 2)"""
+    pairs = scan_pairs(df, similarity_threshold, different_sku, index_min_rows, workers, quantity_blocking)
+    return pairs.to_frame(PAIR_COLUMNS + (['Row 1', 'Row 2'] if with_rows else []))
+
+
+def scan_pairs(df, similarity_threshold=90, different_sku=True, index_min_rows=None, workers=1,
+               quantity_blocking=False):
+    """scan_similar_pairs as a PairTable.
+    With instrumentation on (see instrumentation.collect_stats) the pairs of every brand are counted:
+    generated, same sheet, below threshold, and the rejections of accepted_pairs"""
+    with stage('features'):
+        ids, features = build_feature_table(df['Nombre SKU'])
+        df['Norm Name'] = take_values(ids, features['Norm Name'], categorical=is_compact(df))
+        df['Marca'] = normalize_marca(df['Marca'])
+
+        key_of_id = features['Key'].to_numpy()
+        columns = catalog_columns(df, ids, features, 'Quantity' if quantity_blocking else 'Numbers')
+    sheet_codes = columns['Sheet'][0]
+    brand_codes, brands = columns['Marca']
+    # cheap exact filters that match_brand applies before scoring
+    signatures = columns['Signature'][1][ids]
+    sku_codes, sku_missing = columns['SKU Missing']
+    sku_keys = np.where(sku_missing[sku_codes], -1, sku_codes) if different_sku is False else None
+
+    accumulator = PairAccumulator()
+
+    # brands in order of first appearance, rows without Marca are not compared
+    for marca, rows in zip(brands, group_rows(brand_codes, len(brands))):
+        if pd.isna(marca):
+            continue
+
+        counts = {} if active_stats() is not None else None
+        with stage('scoring'):
+            pos_i, pos_j, scores = match_brand(key_of_id[ids[rows]], sheet_codes[rows], similarity_threshold,
+                                               use_index=index_min_rows is not None and len(rows) >= index_min_rows,
+                                               workers=workers, signatures=signatures[rows],
+                                               skus=None if sku_keys is None else sku_keys[rows], counts=counts)
+        if counts is not None:
+            sheet_sizes = np.bincount(sheet_codes[rows])
+            generated = len(rows) * (len(rows) - 1) // 2
+            counts['Below Threshold'] = counts.pop('Scored') - len(pos_i)
+            count(marca, {'Pairs Generated': generated, 'Same Sheet': int((sheet_sizes * (sheet_sizes - 1) // 2).sum()),
+                          **counts})
+        with stage('pair checks'):
+            accumulator.add(*accepted_pairs(rows[pos_i], rows[pos_j], scores, columns, different_sku, marca))
+
+    return PairTable(columns, features, *accumulator.arrays())
+
+
+def normalize_marca(marca):
+    """Marca without surrounding spaces and in upper case. A categorical Marca is normalized on its categories
+    and stays categorical"""
+    if not isinstance(marca.dtype, pd.CategoricalDtype):
+        return marca.str.strip().str.upper()
+    codes, uniques = pd.factorize(marca.cat.categories.astype(object).str.strip().str.upper())
+    category_codes = marca.cat.codes.to_numpy()
+    return pd.Series(pd.Categorical.from_codes(np.where(category_codes >= 0, codes[category_codes], -1), uniques),
+                     index=marca.index, name=marca.name)
+
+
+def catalog_columns(df, name_ids, features, signature='Numbers'):
+    """Columns of the catalog that pair tables read, as (codes per row, value of every code).
+    Names and Numbers are coded by their row in features (see build_feature_table), the rest by column_codes.
+    SKU Missing flags the codes of missing SKUs. These codes are computed once per scan, not once per brand.
+    Signature codes what two names must share to be compared, -1 for names that are compared with any name:
+    the numbers of the name (signature='Numbers') or its canonical quantity key (signature='Quantity')"""
+    numbers = features['Numbers'].to_numpy()
+    if signature == 'Quantity':
+        signatures, _ = pd.factorize(features['Quantity'])
+    else:
+        signatures, _ = pd.factorize(pd.Series([tuple(nums) for nums in numbers], dtype=object))
+        signatures[[len(nums) == 0 for nums in numbers]] = -1
+    sku_codes, skus = column_codes(df['SKU'])
+    return {
+        'Marca': column_codes(df['Marca']),
+        'Nombre SKU': (name_ids, features['Nombre SKU'].to_numpy()),
+        'SKU': (sku_codes, skus),
+        'SKU Missing': (sku_codes, np.asarray(pd.isna(skus), dtype=bool)),
+        'Sheet': column_codes(df['Sheet']),
+        'Numbers': (name_ids, numbers),
+        'Signature': (name_ids, signatures),
+    }
+
+
+def accepted_pairs(pos_i, pos_j, scores, columns, different_sku=True, marca=None):
+    """Scored pairs (i < j) that pass the SKU relation and number checks, compared by code.
+    With marca the rejections are added to the brand counters of the instrumentation"""
+    sku_codes, sku_missing = columns['SKU Missing']
+    scored = len(pos_i)
+    if different_sku is not None:
+        # a missing SKU is different from every SKU, itself included
+        same_sku = (sku_codes[pos_i] == sku_codes[pos_j]) & ~sku_missing[sku_codes[pos_i]]
+        kept = ~same_sku if different_sku else same_sku
+        pos_i, pos_j, scores = pos_i[kept], pos_j[kept], scores[kept]
+    related = len(pos_i)
+
+    # names with numbers must have the same numbers
+    number_ids, signatures = columns['Signature']
+    signatures_i, signatures_j = signatures[number_ids[pos_i]], signatures[number_ids[pos_j]]
+    different_numbers = (signatures_i >= 0) & (signatures_j >= 0) & (signatures_i != signatures_j)
+    if marca is not None:
+        mismatches = int(different_numbers.sum())
+        count(marca, {'SKU Relation': scored - related, 'Number Mismatch': mismatches,
+                      'Accepted': related - mismatches})
+    return pos_i[~different_numbers], pos_j[~different_numbers], scores[~different_numbers]
+
+
+class PairTable:
+    """
+    Pairs of a scan as columns of row positions (uint32) and scores (uint8).
+    Marca, names, SKUs, sheets and numbers are looked up in the catalog columns (see catalog_columns)
+    only when a column is asked for, so a consumer that needs a few columns never builds the others.
+    flags holds per pair bool arrays (see add_pair_flags), read as columns too.
+    """
 
-                if nums1 and nums2 and (nums1 != nums2):
-                    continue
+    def __init__(self, columns, features, row_i, row_j, scores, flags=None):
+        self.columns = columns
+        self.features = features
+        self.row_i = row_i
+        self.row_j = row_j
+        self.scores = scores
+        self.flags = flags or {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def take(self, positions):
+        """PairTable with the pairs at positions, in that order"""
+        return PairTable(self.columns, self.features, self.row_i[positions], self.row_j[positions],
+                         self.scores[positions], {name: flag[positions] for name, flag in self.flags.items()})
+
+    def name_ids(self):
+        """Rows in features of the names of both sides"""
+        name_ids = self.columns['Nombre SKU'][0]
+        return name_ids[self.row_i], name_ids[self.row_j]
+
+    def column(self, name):
+        """One column of the pair table, with the values of the catalog"""
+        if name == 'Similarity':
+            return self.scores.astype(np.int64)
+        if name in self.flags:
+            return self.flags[name]
+        if name in ('Row 1', 'Row 2'):
+            return (self.row_i if name == 'Row 1' else self.row_j).astype(np.int64)
+        if name == 'Marca':
+            codes, values = self.columns['Marca']
+            return values[codes[self.row_i]]
+
+        base, side = name.rsplit(' ', 1)
+        codes, values = self.columns[base]
+        rows = self.row_i if side == '1' else self.row_j
+        if base == 'Numbers':
+            return pd.Series([list(values[code]) for code in codes[rows]], dtype=object)
+        return values[codes[rows]]
+
+    def to_frame(self, columns=PAIR_COLUMNS):
+        """The pairs as a DataFrame with the given columns"""
+        if not len(self):
+            return pd.DataFrame([], columns=columns)
+        with stage('pair table'):
+            return pd.DataFrame({name: self.column(name) for name in columns})
+
+
+def scan_rows_against_catalog(df, rows, similarity_threshold=90, workers=1):
+    """Pairs of scan_similar_pairs(df, different_sku=None, with_rows=True) that involve at least one of rows
+    (positions in df). Only the brands of those rows are scored"""
+    return scan_rows_pairs(df, rows, similarity_threshold, workers).to_frame(PAIR_COLUMNS + ['Row 1', 'Row 2'])
+
+
+def scan_rows_pairs(df, rows, similarity_threshold=90, workers=1, known_rows=None):
+    """scan_rows_against_catalog as a PairTable. The names of known_rows (positions in df) get features too,
+    so pairs of those rows can be read with the catalog columns of the table"""
+    df['Marca'] = normalize_marca(df['Marca'])
+    brand_codes, brands = column_codes(df['Marca'])
+    affected = np.zeros(len(brands), dtype=bool)
+    affected[brand_codes[rows]] = True
+    affected &= ~pd.isna(brands)
+    affected_rows = np.flatnonzero(affected[brand_codes])
+    feature_rows = affected_rows if known_rows is None else np.union1d(affected_rows, known_rows)
+
+    ids, features = build_feature_table(df['Nombre SKU'].iloc[feature_rows])
+    name_ids = np.full(len(df), -1, dtype=np.int64)
+    name_ids[feature_rows] = ids
+    key_of_id = features['Key'].to_numpy()
+    columns = catalog_columns(df, name_ids, features)
+    sheet_codes = columns['Sheet'][0]
+
+    selected = np.zeros(len(df), dtype=bool)
+    selected[rows] = True
+
+    accumulator = PairAccumulator()
+
+    for marca, block in zip(brands, group_rows(brand_codes, len(brands))):
+        if not affected[brand_codes[block[0]]]:
+            continue
+        pos_i, pos_j, scores = match_rows(key_of_id[name_ids[block]], sheet_codes[block],
+                                          np.flatnonzero(selected[block]), similarity_threshold, workers=workers)
+        accumulator.add(*accepted_pairs(block[pos_i], block[pos_j], scores, columns, None))
+
+    return PairTable(columns, features, *accumulator.arrays())
+
+
+def match_catalog_rows(old, new):
+    """
+    Matches the rows of two snapshots of a catalog by (Sheet, SKU, Nombre SKU) and brand,
+    repeated rows by their occurrence. A row whose brand changed counts as removed and added.
+    Returns the new position of every old row (-1 if it is not in new) and the positions
+    of the new rows that are not in old
+    """
+    key_columns = ['Marca', 'Sheet', 'SKU', 'Nombre SKU']
+
+    def row_keys(df):
+        keys = pd.DataFrame({
+            'Marca': normalize_marca(df['Marca']).astype(object).to_numpy(),
+            'Sheet': df['Sheet'].astype(object).to_numpy(),
+            'SKU': df['SKU'].astype(object).to_numpy(),
+            'Nombre SKU': df['Nombre SKU'].astype(object).to_numpy(),
+        })
+        keys['Occurrence'] = keys.groupby(key_columns, dropna=False, sort=False).cumcount()
+        keys['Position'] = np.arange(len(df))
+        return keys
+
+    merged = row_keys(new).merge(row_keys(old), on=key_columns + ['Occurrence'], how='left',
+                                 suffixes=(' New', ' Old'))
+    found = merged['Position Old'].notna().to_numpy()
+
+    old_to_new = np.full(len(old), -1, dtype=np.int64)
+    old_to_new[merged['Position Old'].to_numpy()[found].astype(np.int64)] = merged['Position New'].to_numpy()[found]
+    added = merged['Position New'].to_numpy()[~found].astype(np.int64)
+    return old_to_new, added
+
+
+def candidate_recall(df, thresholds=(77, 88, 90)):
+    """
+    Compares the candidates of the q-gram index with the exhaustive scoring of every brand.
+    Returns a table per threshold with the number of cross-sheet pairs, candidates sent to the scorer,
+    matches of the exhaustive path, the recall of the index (share of those matches that are candidates)
+    and the time of both paths
+    """
+    ids, features = build_feature_table(df['Nombre SKU'])
+    brand_codes, brands = column_codes(normalize_marca(df['Marca']))
+    keys = features['Key'].to_numpy()[ids]
+    sheets, _ = column_codes(df['Sheet'])
+    brand_rows = {marca: rows for marca, rows in zip(brands, group_rows(brand_codes, len(brands))) if not pd.isna(marca)}
+
+    report = []
+    for threshold in thresholds:
+        cross_sheet, candidates, matches, found = 0, 0, 0, 0
+        exhaustive_time, index_time = 0.0, 0.0
+        for rows in brand_rows.values():
+            block_sheets = sheets[rows]
+            sheet_sizes = pd.Series(block_sheets).value_counts().to_numpy()
+            cross_sheet += (sheet_sizes.sum() ** 2 - (sheet_sizes ** 2).sum()) // 2
+
+            start = time.perf_counter()
+            exhaustive_i, exhaustive_j, _ = match_brand(keys[rows], block_sheets, threshold)
+            exhaustive_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            index_i, index_j = candidate_pairs(keys[rows], block_sheets, threshold)
+            index_time += time.perf_counter() - start
+            candidate_set = set(zip(index_i.tolist(), index_j.tolist()))
+
+            candidates += len(candidate_set)
+            matches += len(exhaustive_i)
+            found += sum((i, j) in candidate_set for i, j in zip(exhaustive_i.tolist(), exhaustive_j.tolist()))
+
+        report.append({
+            'Threshold': threshold,
+            'Cross-sheet pairs': int(cross_sheet),
+            'Candidates': candidates,
+            'Matches': matches,
+            'Recall': found / matches if matches else 1.0,
+            'Exhaustive seconds': round(exhaustive_time, 3),
+            'Index seconds': round(index_time, 3)
+        })
+
+    return pd.DataFrame(report)
 
-                similar_groups.append({
-                    'Marca': marca,
-                    'Nombre SKU 1': row_i['Nombre SKU'],
-                    'SKU 1': row_i['SKU'],
-                    'Sheet 1': row_i['Sheet'],
-                    'Nombre SKU 2': row_j['Nombre SKU'],
-                    'SKU 2': row_j['SKU'],
-                    'Sheet 2': row_j['Sheet'],
-                    'Similarity': sim,
-                    'Numbers 1': nums1,
-                    'Numbers 2': nums2
-                })
 
-    return pd.DataFrame(similar_groups).sort_values(by="Similarity", ascending=False).reset_index(drop=True)
+def is_different_flavor(name1: str, name2: str, min_len: int = 4, max_sim: float = 0.6) -> bool:
+    long1, short1 = split_flavor_tokens(name1, min_len)
+    long2, short2 = split_flavor_tokens(name2, min_len)
+    # Add short flavor exceptions to the long token sets
+    tokens1 = long1 | {w for w in short1 if w in FLAVOR_EXCEPTIONS}
+    tokens2 = long2 | {w for w in short2 if w in FLAVOR_EXCEPTIONS}
+    return is_different_flavor_tokens(tokens1, short1, tokens2, short2, max_sim)
 
 
-def is_different_flavor(name1: str, name2: str, min_len: int = 4, max_sim: float = 0.6) -> bool:
-    FLAVOR_EXCEPTIONS = {"ajo", "té", "sal", "pic", "lim", "ají"}
-
-    def clean_and_split(text):
-        # Replace common special symbols with letter approximations
-        replacements = {
-            "¥": "n",  # like in word pina, which was written incorrectly with that symbol
-            "$": "s",
-            "€": "e",
-        }
-        for symbol, replacement in replacements.items():
-            text = text.replace(symbol, replacement)
-        words = re.findall(r'\b[\wÀ-ÿ]+\b', text.lower())
-
-        long_words = {w for w in words if len(w) >= min_len and not w.isdigit()}
-        short_words = {w for w in words if 0 < len(w) < min_len and not w.isdigit()}
-        return long_words, short_words
+def is_different_flavor_tokens(tokens1, short1, tokens2, short2, max_sim=0.6, neighbors=None):
+    """is_different_flavor on precomputed Flavor Tokens and Short Tokens (see build_feature_table).
+    With neighbors (see token_neighbors) similar words are a set lookup instead of edit distances"""
 
     def fuzzy_set_difference(set1, set2):
+        if neighbors is not None:
+            return [w1 for w1 in set1 if neighbors[w1].isdisjoint(set2)]
+
         unique = []
         for w1 in set1:
             found_similar = False
             for w2 in set2:
-                max_allowed_edits = 1 if len(w1) <= 6 else 2
+                max_allowed_edits = allowed_edits(w1)
                 if levenshtein_distance(w1, w2) <= max_allowed_edits:
                     found_similar = True
                     break
@@ -146,12 +492,6 @@ def is_different_flavor(name1: str, name2: str, min_len: int = 4, max_sim: float
                 unique.append(w1)
         return unique
 
-    tokens1, short1 = clean_and_split(name1)
-    tokens2, short2 = clean_and_split(name2)
-    # Add short flavor exceptions to the long token sets
-    tokens1 |= {w for w in short1 if w.lower() in FLAVOR_EXCEPTIONS}
-    tokens2 |= {w for w in short2 if w.lower() in FLAVOR_EXCEPTIONS}
-
     unique1 = fuzzy_set_difference(tokens1, tokens2)
     unique2 = fuzzy_set_difference(tokens2, tokens1)
 
@@ -170,17 +510,105 @@ def is_different_flavor(name1: str, name2: str, min_len: int = 4, max_sim: float
     return False
 
 
+def allowed_edits(token):
+    """Edits fuzzy_set_difference allows between two forms of the same word"""
+    return 1 if len(token) <= 6 else 2
+
+
+def deletion_variants(token, max_deletions):
+    """The token with every combination of up to max_deletions letters removed"""
+    variants = {token}
+    frontier = {token}
+    for _ in range(max_deletions):
+        frontier = {w[:k] + w[k + 1:] for w in frontier for k in range(len(w))}
+        variants |= frontier
+    return variants
+
+
+def token_neighbors(vocabulary):
+    """
+    For every token of the vocabulary, the tokens within allowed_edits of it (itself included).
+    Two tokens within k edits share a deletion variant with at most k deletions on each side,
+    so only tokens that share a variant in the deletion index are checked with levenshtein_distance.
+    """
+    index = defaultdict(set)
+    for token in vocabulary:
+        for variant in deletion_variants(token, 2):
+            index[variant].add(token)
+
+    neighbors = {}
+    for token in vocabulary:
+        max_allowed_edits = allowed_edits(token)
+        candidates = set()
+        for variant in deletion_variants(token, max_allowed_edits):
+            candidates |= index[variant]
+        neighbors[token] = frozenset(c for c in candidates if levenshtein_distance(token, c) <= max_allowed_edits)
+    return neighbors
+
+
 def remove_flavor_variants(df: pd.DataFrame) -> pd.DataFrame:
-    mask = df.apply(
-        lambda row: is_different_flavor(row["Nombre SKU 1"], row["Nombre SKU 2"]),
-        axis=1
-    )
+    """Pairs that are not flavor variants, df is a DataFrame or a PairTable"""
+    mask = flavor_variant_mask(df)
+    count_flavor_variants(df, mask)
+    if isinstance(df, PairTable):
+        return df.take(np.flatnonzero(~mask))
     return df[~mask].reset_index(drop=True)
 
 
+def flavor_variant_mask(df):
+    """is_different_flavor for every pair of the table.
+    Features are built once per unique name of the pairs and looked up by id for each pair,
+    similar words come from the token_neighbors of the vocabulary of each brand.
+    A PairTable already has the features of its names, only the name ids of the pairs are read"""
+    with stage('flavor filter'):
+        return flavor_mask(df)
+
+
+def flavor_mask(df):
+    """flavor_variant_mask without the stage timing"""
+    if isinstance(df, PairTable):
+        ids1, ids2 = df.name_ids()
+        features = df.features
+        brand_column = df.column('Marca')
+    else:
+        names = pd.concat([df["Nombre SKU 1"], df["Nombre SKU 2"]], ignore_index=True)
+        ids, features = build_feature_table(names)
+        ids1, ids2 = ids[:len(df)], ids[len(df):]
+        brand_column = df['Marca'] if 'Marca' in df.columns else np.zeros(len(df))
+    tokens = features['Flavor Tokens'].to_numpy()
+    short = features['Short Tokens'].to_numpy()
+
+    brands, _ = pd.factorize(np.asarray(brand_column, dtype=object), use_na_sentinel=False)
+    mask = np.zeros(len(df), dtype=bool)
+
+    for brand, rows in pd.Series(np.arange(len(df))).groupby(brands).indices.items():
+        brand_ids = np.union1d(ids1[rows], ids2[rows])
+        neighbors = token_neighbors(set().union(*tokens[brand_ids]))
+        for row in rows:
+            i, j = ids1[row], ids2[row]
+            mask[row] = is_different_flavor_tokens(tokens[i], short[i], tokens[j], short[j], neighbors=neighbors)
+
+    return mask
+
+
+def count_flavor_variants(df, mask):
+    """Adds the flavor variants of the final mask of a table to the brand counters of the instrumentation.
+    Masks are not counted where they are computed, so a mask computed again for the same pairs is not counted twice"""
+    if active_stats() is None or not len(df) or not isinstance(df, PairTable) and 'Marca' not in df.columns:
+        return
+    brands = df.column('Marca') if isinstance(df, PairTable) else df['Marca']
+    per_brand = pd.Series(mask).groupby(np.asarray(brands, dtype=object), sort=False).sum()
+    for marca, variants in per_brand.items():
+        count(marca, {'Flavor Variants': variants})
+
+
 def is_sku_too_close(row):
+    return skus_too_close(row['SKU 1'], row['SKU 2'])
+
+
+def skus_too_close(sku1, sku2):
     try:
-        return abs(int(row['SKU 1']) - int(row['SKU 2'])) <= 3
+        return abs(int(sku1) - int(sku2)) <= 3
     except:
         return False
 
@@ -188,30 +616,26 @@ def is_sku_too_close(row):
 def process_excel_for_duplicates(
         excel_path,
         confidence_threshold=93,
-        low_confidence_threshold=90
+        low_confidence_threshold=90,
+        previous_run=None,
+        cache_dir=None
 ):
-    df_all = load_all_sheets(excel_path)
-    similar_df = find_similar_products(df_all, similarity_threshold=low_confidence_threshold)
+    """With previous_run (a folder) the pairs of the last run saved there are updated with
+    MatchResult.update instead of scoring everything again, and this run is saved for the next one.
+    cache_dir is the cache of load_all_sheets"""
+    df_all = load_all_sheets(excel_path, cache_dir=cache_dir)
 
-    if similar_df.empty:
-        return pd.DataFrame(), pd.DataFrame()
-    similar_df = similar_df.copy()
-    similar_df = remove_flavor_variants(similar_df)
+    matches = None
+    if previous_run is not None:
+        previous = MatchResult.load(previous_run)
+        if previous is not None and previous.min_threshold <= low_confidence_threshold:
+            matches = previous.update(df_all)
+    if matches is None:
+        matches = MatchResult(df_all, min_threshold=low_confidence_threshold)
+    if previous_run is not None:
+        matches.save(previous_run)
 
-    filtered_df = similar_df[~similar_df.apply(is_sku_too_close, axis=1)]
-
-    confident_df = filtered_df[filtered_df['Similarity'] >= confidence_threshold]
-    needs_review_df = pd.concat([
-        filtered_df[
-            (filtered_df['Similarity'] >= low_confidence_threshold) &
-            (filtered_df['Similarity'] < confidence_threshold)
-            ],
-    ], ignore_index=True)
-
-    confident_df = confident_df.sort_values(by='Similarity', ascending=False).reset_index(drop=True)
-    needs_review_df = needs_review_df.sort_values(by='Similarity', ascending=False).reset_index(drop=True)
-
-    return confident_df, needs_review_df
+    return matches.different_sku_matches(confidence_threshold, low_confidence_threshold)
 
 
 def process_excel_for_duplicates_and_split_by_company(
@@ -219,124 +643,288 @@ def process_excel_for_duplicates_and_split_by_company(
         confidence_threshold=93,
         low_confidence_threshold=88
 ):
-    """Group by subcompany"""
-    full_data = load_all_sheets(excel_path)
+    """Group by subcompany: CompanyPairs of confident and needs_review, keyed by the companies of confident"""
     confident, needs_review = process_excel_for_duplicates(
         excel_path,
         confidence_threshold=confidence_threshold,
         low_confidence_threshold=low_confidence_threshold
     )
-    all_companies = pd.unique(
-        pd.concat([confident["Sheet 1"], confident["Sheet 2"]], ignore_index=True)
-    )
-
-    grouped_confident = {}
-    grouped_review = {}
-
-    for company in all_companies:
-        confident_rows = confident[
-            (confident["Sheet 1"] == company) | (confident["Sheet 2"] == company)
-            ]
-        review_rows = needs_review[
-            (needs_review["Sheet 1"] == company) | (needs_review["Sheet 2"] == company)
-            ]
-
-        grouped_confident[company] = confident_rows
-        grouped_review[company] = review_rows
-
-    return grouped_confident, grouped_review
+    grouped_confident = CompanyPairs(confident)
+    return grouped_confident, CompanyPairs(needs_review, grouped_confident.companies)
 
 
 def split_matches_by_company(exact_df, partial_df):
-    """Group by subcompany"""
+    """Group by subcompany: CompanyPairs of both tables, keyed by the companies of either table"""
     all_companies = pd.unique(
         pd.concat([exact_df["Sheet 1"], exact_df["Sheet 2"],
                    partial_df["Sheet 1"], partial_df["Sheet 2"]], ignore_index=True)
     )
-
-    grouped_exact = {}
-    grouped_partial = {}
-
-    for company in all_companies:
-        grouped_exact[company] = exact_df[
-            (exact_df["Sheet 1"] == company) | (exact_df["Sheet 2"] == company)
-            ]
-        grouped_partial[company] = partial_df[
-            (partial_df["Sheet 1"] == company) | (partial_df["Sheet 2"] == company)
-            ]
-
-    return grouped_exact, grouped_partial
+    return CompanyPairs(exact_df, all_companies), CompanyPairs(partial_df, all_companies)
 
 
 def subtract_table(df_all, confident):
     """find samples from df_all that are not present in other df confident"""
-    confident_pairs_1 = list(zip(confident['Marca'], confident['Nombre SKU 1'], confident['SKU 1']))
-    confident_pairs_2 = list(zip(confident['Marca'], confident['Nombre SKU 2'], confident['SKU 2']))
-
-    confident_pairs_set = set(confident_pairs_1 + confident_pairs_2)
-    filtered_df = df_all[
-        ~df_all.apply(lambda row: (row['Marca'], row["Nombre SKU"], row['SKU']) in confident_pairs_set, axis=1)]
-    return filtered_df
+    return subtract_tables(df_all, confident)
 
 
-def find_normal_cases(excel_path):
+def subtract_tables(df_all, *tables):
+    """
+    Rows of df_all whose (Marca, Nombre SKU, SKU) is not on either side of any of the pair tables.
+    Vectorized anti-join: every key column is factorized once over the catalog and all tables together,
+    the codes are combined into one integer key per row and compared with np.isin.
+    """
+    key_columns = ['Marca', 'Nombre SKU', 'SKU']
+    sides = [(table['Marca'], table[f'Nombre SKU {n}'], table[f'SKU {n}'])
+             for table in tables if not table.empty for n in ('1', '2')]
+    if not sides:
+        return df_all
+
+    row_keys = np.zeros(len(df_all) + sum(len(side[0]) for side in sides), dtype=np.int64)
+    for k, column in enumerate(key_columns):
+        # catalog values are coded once per distinct value, then joined with the values of the tables
+        catalog_codes, catalog_values = column_codes(df_all[column])
+        values = np.concatenate([np.asarray(catalog_values, dtype=object)] +
+                                [side[k].to_numpy(dtype=object) for side in sides])
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        codes = np.concatenate([codes[catalog_codes], codes[len(catalog_values):]])
+        # re-factorize so the combined key stays a small integer
+        row_keys, _ = pd.factorize(row_keys * len(uniques) + codes)
+
+    found = np.isin(row_keys[:len(df_all)], row_keys[len(df_all):])
+    return df_all[~found]
+
+
+def find_normal_cases(excel_path, cache_dir=None):
     """Finds products that do not have similar by name, sku products in other companies as products that are nor belong to other categories"""
-    data = load_all_sheets(excel_path)
-
-    correct_products = find_similar_products(data, 88, different_sku=False)
-    correct_products = correct_products.copy()
-    correct_products = remove_flavor_variants(correct_products)
-    columns_to_show = [col for col in correct_products.columns if col not in ['Numbers 1', 'Numbers 2']]
-    correct_products = correct_products.loc[:, columns_to_show]
-    exact_matches = correct_products[correct_products['Similarity'] == 100]
-    partial_matches = correct_products[correct_products['Similarity'] < 100]
-    confident, needs_review = process_excel_for_duplicates(
-        excel_path,
-        confidence_threshold=93,
-        low_confidence_threshold=77
-    )
-    df_all = load_all_sheets(excel_path)
+    df_all = load_all_sheets(excel_path, cache_dir=cache_dir)
     print(df_all.shape)
-    filtered = subtract_table(df_all, confident)
+    filtered = MatchResult(df_all, min_threshold=77).unique_products()
     print(filtered.shape)
-    filtered = subtract_table(filtered, needs_review)
-    filtered = subtract_table(filtered, exact_matches)
-    filtered = subtract_table(filtered, partial_matches)
     return filtered
 
 
+PAIR_FLAGS = ['Same SKU', 'Flavor Variant', 'SKU Too Close']
+
+
+def add_pair_flags(pairs):
+    """The pairs of a PairTable with the flags of MatchResult (PAIR_FLAGS) as bool arrays:
+    Same SKU, Flavor Variant and SKU Too Close. SKUs are compared by code, skus_too_close once per SKU value"""
+    sku_codes, sku_missing = pairs.columns['SKU Missing']
+    codes_i, codes_j = sku_codes[pairs.row_i], sku_codes[pairs.row_j]
+    same_sku = (codes_i == codes_j) & ~sku_missing[codes_i]
+    flavor_variant = flavor_variant_mask(pairs)
+    count_flavor_variants(pairs, flavor_variant)
+    with stage('sku too close'):
+        integers, known = sku_integers(pairs.columns['SKU'][1])
+        too_close = known[codes_i] & known[codes_j]
+        too_close[too_close] = (np.abs(integers[codes_i[too_close]] - integers[codes_j[too_close]]) <= 3).astype(bool)
+    if active_stats() is not None and len(pairs):
+        near_sku = pd.Series(too_close & ~same_sku).groupby(np.asarray(pairs.column('Marca'), dtype=object),
+                                                            sort=False).sum()
+        for marca, near in near_sku.items():
+            count(marca, {'Near SKU': near})
+    flags = {'Same SKU': same_sku, 'Flavor Variant': flavor_variant, 'SKU Too Close': too_close}
+    return PairTable(pairs.columns, pairs.features, pairs.row_i, pairs.row_j, pairs.scores, flags)
+
+
+def sku_integers(skus):
+    """int(sku) of every SKU value (Python ints in an object array) and whether it has one, as in skus_too_close"""
+    integers = np.zeros(len(skus), dtype=object)
+    known = np.zeros(len(skus), dtype=bool)
+    for k, sku in enumerate(skus):
+        try:
+            integers[k] = int(sku)
+            known[k] = True
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return integers, known
+
+
+class MatchResult:
+    """
+    All cross-sheet pairs of a catalog that reach min_threshold, found in one scoring pass
+    with both SKU relations, plus per pair flags: Same SKU, Flavor Variant and SKU Too Close.
+
+    The pairs are a PairTable (row positions, scores and the flag arrays, see add_pair_flags): names, SKUs
+    and sheets are only read from the catalog for the pairs of a view. The tables of the report
+    (exact, partial, confident, needs review, unique products) are filtered views of these pairs,
+    so any threshold >= min_threshold costs no new scan.
+    Views return the same tables as the functions they replace (similar also keeps the flag and Row columns).
+    Every view is a list of pair positions first (the *_rows methods), the long format of the pairs (store)
+    is built once and the stores of the views are subsets of it.
+    """
+
+    def __init__(self, catalog, min_threshold=77, workers=1, pairs=None):
+        self.catalog = catalog
+        self.min_threshold = min_threshold
+
+        if pairs is None:
+            # pairs are kept in the order they were found, views sort them like find_similar_products
+            pairs = add_pair_flags(scan_pairs(catalog.copy(), min_threshold, different_sku=None, workers=workers))
+        self.pairs = pairs
+        self._store = None
+
+    def update(self, catalog, workers=1):
+        """
+        MatchResult of a new snapshot of the catalog without a full scan.
+        Rows are matched with the previous catalog (match_catalog_rows): pairs of two kept rows are reused,
+        pairs with a removed row are dropped, and only added or changed rows are scored against their brand.
+        The result is the same as MatchResult(catalog, self.min_threshold)
+        """
+        old_to_new, added = match_catalog_rows(self.catalog, catalog)
+
+        row1, row2 = old_to_new[self.pairs.row_i], old_to_new[self.pairs.row_j]
+        kept = np.flatnonzero((row1 >= 0) & (row2 >= 0))
+        row1, row2 = row1[kept], row2[kept]
+
+        # the kept pairs are read with the catalog columns of the new pairs, their rows get features too
+        new_pairs = add_pair_flags(scan_rows_pairs(catalog.copy(), added, self.min_threshold, workers,
+                                                   known_rows=np.concatenate([row1, row2])))
+
+        # rows can change order in the new snapshot, the first row of a pair is always the earlier one
+        pairs = PairTable(new_pairs.columns, new_pairs.features,
+                          np.concatenate([np.minimum(row1, row2), new_pairs.row_i]).astype(np.uint32),
+                          np.concatenate([np.maximum(row1, row2), new_pairs.row_j]).astype(np.uint32),
+                          np.concatenate([self.pairs.scores[kept], new_pairs.scores]),
+                          {name: np.concatenate([self.pairs.flags[name][kept], new_pairs.flags[name]])
+                           for name in PAIR_FLAGS})
+        swapped = np.flatnonzero(row1 > row2)
+        pairs.flags['Flavor Variant'][swapped] = flavor_variant_mask(pairs.take(swapped))
+
+        brand_order = {marca: rank for rank, marca in enumerate(normalize_marca(catalog['Marca']).unique())}
+        brand_ranks = pd.Series(pairs.column('Marca'), dtype=object).map(brand_order).to_numpy()
+        # a new result, its store is built from its own pairs
+        return MatchResult(catalog, self.min_threshold,
+                           pairs=pairs.take(np.lexsort((pairs.row_j, pairs.row_i, brand_ranks))))
+
+    def store(self):
+        """PairStore of all the pairs, built on first use and kept"""
+        if self._store is None:
+            self._store = PairStore(self.pairs.to_frame(['Marca', 'Nombre SKU 1', 'SKU 1', 'Sheet 1',
+                                                         'Nombre SKU 2', 'SKU 2', 'Sheet 2']))
+        return self._store
+
+    def save(self, path):
+        """Saves catalog and pairs in the folder path, read them back with MatchResult.load"""
+        os.makedirs(path, exist_ok=True)
+        save_frame(self.catalog, os.path.join(path, 'catalog'))
+        # rows, scores and flags of the pairs, the other columns are read again from the catalog on load
+        save_frame(self.pairs.to_frame(['Row 1', 'Row 2', 'Similarity'] + PAIR_FLAGS), os.path.join(path, 'pairs'))
+        with open(os.path.join(path, 'match_result.json'), 'w') as f:
+            json.dump({'min_threshold': self.min_threshold}, f)
+
+    @classmethod
+    def load(cls, path):
+        """MatchResult saved with save, None if the folder has none"""
+        meta_path = os.path.join(path, 'match_result.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        catalog = load_frame(os.path.join(path, 'catalog'))
+        saved = load_frame(os.path.join(path, 'pairs'))
+        columns = catalog.copy()
+        columns['Marca'] = normalize_marca(columns['Marca'])
+        ids, features = build_feature_table(columns['Nombre SKU'])
+        pairs = PairTable(catalog_columns(columns, ids, features), features,
+                          saved['Row 1'].to_numpy(dtype=np.uint32), saved['Row 2'].to_numpy(dtype=np.uint32),
+                          saved['Similarity'].to_numpy(dtype=np.uint8),
+                          {name: saved[name].to_numpy(dtype=bool) for name in PAIR_FLAGS})
+        return cls(catalog, meta['min_threshold'], pairs=pairs)
+
+    def sorted_rows(self, rows):
+        """Pair positions in the order sort_values(by="Similarity", ascending=False) gives their rows"""
+        similarity = pd.Series(self.pairs.column('Similarity')[rows])
+        return rows[similarity.sort_values(ascending=False).index.to_numpy()]
+
+    def similar_rows(self, similarity_threshold, different_sku=True):
+        """Positions of the pairs of similar, in its order"""
+        self._check_threshold(similarity_threshold)
+        same_sku = self.pairs.flags['Same SKU']
+        relation = ~same_sku if different_sku else same_sku
+        return self.sorted_rows(np.flatnonzero(relation & (self.pairs.scores >= similarity_threshold)))
+
+    def similar(self, similarity_threshold, different_sku=True):
+        """Same table as find_similar_products(catalog, similarity_threshold, different_sku)"""
+        rows = self.similar_rows(similarity_threshold, different_sku)
+        return self.pairs.take(rows).to_frame(PAIR_COLUMNS + ['Row 1', 'Row 2'] + PAIR_FLAGS)
+
+    def same_sku_rows(self, similarity_threshold=88):
+        """Positions of the pairs of same_sku_matches: (correct products, exact matches, partial matches)"""
+        rows = self.similar_rows(similarity_threshold, different_sku=False)
+        rows = rows[~self.pairs.flags['Flavor Variant'][rows]]
+        similarity = self.pairs.scores[rows]
+        return rows, rows[similarity == 100], rows[similarity < 100]
+
+    def same_sku_matches(self, similarity_threshold=88):
+        """Exact (Similarity == 100) and partial matches of products with the same SKU, without flavor variants"""
+        rows, _, _ = self.same_sku_rows(similarity_threshold)
+        correct_products = self.pairs.take(rows).to_frame(
+            [col for col in PAIR_COLUMNS if col not in ['Numbers 1', 'Numbers 2']])
+        exact_matches = correct_products[correct_products['Similarity'] == 100]
+        partial_matches = correct_products[correct_products['Similarity'] < 100]
+        return exact_matches, partial_matches
+
+    def same_sku_stores(self, similarity_threshold=88):
+        """PairStores of the exact and partial matches of same_sku_matches, subsets of store()"""
+        _, exact, partial = self.same_sku_rows(similarity_threshold)
+        return self.store().subset(exact), self.store().subset(partial)
+
+    def different_sku_rows(self, confidence_threshold=93, low_confidence_threshold=90):
+        """Positions of the pairs of different_sku_matches: (confident, needs review), None when there are no similar pairs"""
+        rows = self.similar_rows(low_confidence_threshold, different_sku=True)
+        if not len(rows):
+            return None
+        rows = rows[~self.pairs.flags['Flavor Variant'][rows]]
+        rows = rows[~self.pairs.flags['SKU Too Close'][rows]]
+        similarity = self.pairs.scores[rows]
+        confident = rows[similarity >= confidence_threshold]
+        needs_review = rows[(similarity >= low_confidence_threshold) & (similarity < confidence_threshold)]
+        return self.sorted_rows(confident), self.sorted_rows(needs_review)
+
+    def different_sku_matches(self, confidence_threshold=93, low_confidence_threshold=90):
+        """Confident and needs review tables of process_excel_for_duplicates"""
+        rows = self.different_sku_rows(confidence_threshold, low_confidence_threshold)
+        if rows is None:
+            return pd.DataFrame(), pd.DataFrame()
+        confident_df, needs_review_df = (self.pairs.take(table_rows).to_frame(PAIR_COLUMNS) for table_rows in rows)
+        return confident_df, needs_review_df
+
+    def different_sku_stores(self, confidence_threshold=93, low_confidence_threshold=90):
+        """PairStores of the confident and needs review tables of different_sku_matches, subsets of store()"""
+        rows = self.different_sku_rows(confidence_threshold, low_confidence_threshold)
+        empty = np.zeros(0, dtype=np.int64)
+        confident, needs_review = rows if rows is not None else (empty, empty)
+        return self.store().subset(confident), self.store().subset(needs_review)
+
+    def unique_products(self, confidence_threshold=93, low_confidence_threshold=77, same_sku_threshold=88):
+        """Catalog rows that are in none of the other tables (find_normal_cases)"""
+        exact_matches, partial_matches = self.same_sku_matches(same_sku_threshold)
+        confident, needs_review = self.different_sku_matches(confidence_threshold, low_confidence_threshold)
+        with stage('subtract tables'):
+            return subtract_tables(self.catalog, confident, needs_review, exact_matches, partial_matches)
+
+    def _check_threshold(self, similarity_threshold):
+        if similarity_threshold < self.min_threshold:
+            raise ValueError(f"Threshold {similarity_threshold} is below the scanned minimum {self.min_threshold}")
+
+
 def pairs_to_unique_products(table):
-    """Receives dict of dfs for each subcompany with pairs of products
+    """Receives dict of dfs for each subcompany with pairs of products (or CompanyPairs)
     Returns dict of dfs for each subcompany with unique products
     """
     products_grouped_review = {}
 
+    if isinstance(table, CompanyPairs):
+        return table.unique_products()
     if isinstance(table, dict):
         for company, df in table.items():
-            df1 = df[['Marca', 'Nombre SKU 1', 'SKU 1', 'Sheet 1']].copy()
-            df1.columns = ['Marca', 'Nombre SKU', 'SKU', 'Sheet']
-
-            df2 = df[['Marca', 'Nombre SKU 2', 'SKU 2', 'Sheet 2']].copy()
-            df2.columns = ['Marca', 'Nombre SKU', 'SKU', 'Sheet']
-
-            combined = pd.concat([df1, df2], ignore_index=True)
-            filtered = combined[combined['Sheet'] == company].reset_index(drop=True)
-            filtered = filtered.drop_duplicates(subset=['Marca', 'Nombre SKU', 'SKU', "Sheet"]).reset_index(drop=True)
-            products_grouped_review[company] = filtered
+            products = PairStore(df).products()
+            products_grouped_review[company] = products[products['Sheet'] == company].reset_index(drop=True)
     else:
         # if there is one table
-        df = table
-
-        df1 = df[['Marca', 'Nombre SKU 1', 'SKU 1', 'Sheet 1']].copy()
-        df1.columns = ['Marca', 'Nombre SKU', 'SKU', 'Sheet']
-
-        df2 = df[['Marca', 'Nombre SKU 2', 'SKU 2', 'Sheet 2']].copy()
-        df2.columns = ['Marca', 'Nombre SKU', 'SKU', 'Sheet']
-
-        combined = pd.concat([df1, df2], ignore_index=True)
-        filtered = combined.reset_index(drop=True)
-        filtered = filtered.drop_duplicates(subset=['Marca', 'Nombre SKU', 'SKU', "Sheet"]).reset_index(drop=True)
-        return filtered
+        return PairStore(table).products()
 
     return products_grouped_review
 
@@ -345,38 +933,11 @@ def count_unique_subempresas_per_product(df):
     """
     For each product (Nombre SKU, SKU), count how many unique subcompanies (sheets) it appears in
     Products that are matched (appear in same row) are considered part of the same group.
-    Use graph to register connection between related products
+    Groups come from the union-find of grouping.group_products, products of a group are consecutive
     """
-
-    G = nx.Graph()
-
-    for _, row in df.iterrows():
-        prod1 = (row['Nombre SKU 1'], row['SKU 1'])
-        prod2 = (row['Nombre SKU 2'], row['SKU 2'])
-        G.add_edge(prod1, prod2)
-
-    product_groups = list(nx.connected_components(G))
-
-    product_to_sheets = defaultdict(set)
-
-    for _, row in df.iterrows():
-        prod1 = (row['Nombre SKU 1'], row['SKU 1'])
-        prod2 = (row['Nombre SKU 2'], row['SKU 2'])
-
-        product_to_sheets[prod1].add(row['Sheet 1'])
-        product_to_sheets[prod2].add(row['Sheet 2'])
-
-    result = {}
-
-    for group in product_groups:
-        all_sheets = set()
-        for product in group:
-            all_sheets.update(product_to_sheets[product])
-
-        for product in group:
-            result[product] = len(all_sheets)
-
-    return result
+    products = group_products(df).sort_values('Group', kind='stable')
+    return {(name, sku): int(count) for name, sku, count in zip(products['Nombre SKU'], products['SKU'],
+                                                                 products['Sheets'])}
 
 
 def count_product_distribution_dict_only(product_company_counts):
@@ -397,23 +958,16 @@ def count_product_distribution_dict_only(product_company_counts):
     return statistics
 
 
-def count_unique_products_per_sheet(exact_match_df):
-    all_products = []
-
-    for i in range(len(exact_match_df)):
-        row = exact_match_df.iloc[i]
-        all_products.append((row['Sheet 1'], row['SKU 1'], row['Nombre SKU 1'], row["Marca"]))
-        all_products.append((row['Sheet 2'], row['SKU 2'], row['Nombre SKU 2'], row["Marca"]))
-
-    product_df = pd.DataFrame(all_products, columns=["Sheet", "SKU", "Nombre SKU", "Marca"])
-
-    # Drop duplicates across all columns (Sheet + SKU + Nombre SKU + Marca)
-    unique_df = product_df.drop_duplicates(subset=["Sheet", "SKU", "Nombre SKU", "Marca"])
+def count_product_distribution(df):
+    """Create a dict
+    number of subcompanies: how many product groups of the pair table appear in that many subcompanies"""
+    return group_distribution(group_products(df))
 
-    # Now count per Sheet
-    counts = unique_df.groupby("Sheet").size().to_dict()
 
-    return counts
+def count_unique_products_per_sheet(exact_match_df):
+    """{sheet: distinct products (Sheet, SKU, Nombre SKU, Marca) of the pair table in that sheet}, sheets sorted"""
+    store = exact_match_df if isinstance(exact_match_df, PairStore) else PairStore(exact_match_df)
+    return store.products_per_sheet()
 
 
 def find_common_products(dfs, df_names=None):
@@ -1,47 +1,142 @@
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 import traceback
-import time
 import os
+import hashlib
+import shutil
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from cache import DEFAULT_CACHE_DIR, save_frame, load_frame, file_digest
 
-def search_product_url(base_url, product_code):
-    options = webdriver.ChromeOptions()
-    driver = webdriver.Chrome(options=options)
+IMAGE_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "images")
 
-    try:
-        driver.get(base_url)
+SEARCH_INPUT_XPATH = '//*[@id="oro_website_search_search"]/input'
+SEARCH_BUTTON_XPATH = '//*[@id="oro_website_search_search"]/button'
+PRODUCT_IMAGE_XPATH = '//span[normalize-space(text())="Código {product_code}"]/../../../../..//a//img'
+
+
+class SeleniumBackend:
+    """
+    One long lived Chrome that looks up product image urls in the store search.
+    Instead of fixed sleeps it waits until the page is loaded, the search box is clickable
+    and the product image has its src. lookup returns None when the product is not found within timeout.
+    selenium is imported here, the rest of the module (session, download cache, backend pool) works without it
+    """
+
+    def __init__(self, base_url, timeout=15, headless=True):
+        from selenium import webdriver
+        from selenium.webdriver.support.ui import WebDriverWait
 
-        wait = WebDriverWait(driver, 15)
-        time.sleep(10)
+        options = webdriver.ChromeOptions()
+        if headless:
+            options.add_argument("--headless=new")
+        self.base_url = base_url
+        self.driver = webdriver.Chrome(options=options)
+        self.wait = WebDriverWait(self.driver, timeout)
 
-        # Hacer clic en el ícono de búsqueda
-        input_search = wait.until(
-            EC.visibility_of_element_located((By.XPATH, '//*[@id="oro_website_search_search"]/input')))
-        input_search.send_keys(product_code)
+    def lookup(self, product_code):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException
 
-        # Escribir el código del producto
-        button_search = wait.until(
-            EC.visibility_of_element_located((By.XPATH, '//*[@id="oro_website_search_search"]/button')))
-        button_search.click()
+        driver, wait = self.driver, self.wait
+        driver.get(self.base_url)
+        wait.until(lambda d: d.execute_script("return document.readyState") == "complete")
 
-        exist_product = wait.until(EC.visibility_of_element_located((
-            By.XPATH,
-            f'//span[normalize-space(text())="Código {product_code}"]/../../../../..//a//img'
-        )))
+        # Escribir el código del producto y buscar
+        input_search = wait.until(EC.element_to_be_clickable((By.XPATH, SEARCH_INPUT_XPATH)))
+        input_search.clear()
+        input_search.send_keys(str(product_code))
+        wait.until(EC.element_to_be_clickable((By.XPATH, SEARCH_BUTTON_XPATH))).click()
 
-        time.sleep(5)
-        return exist_product.get_attribute("src")
+        try:
+            image = wait.until(EC.visibility_of_element_located(
+                (By.XPATH, PRODUCT_IMAGE_XPATH.format(product_code=product_code))))
+        except TimeoutException:
+            return None
+        # the src can be set after the image is visible (lazy loading)
+        return wait.until(lambda d: image.get_attribute("src") or False)
 
+    def close(self):
+        self.driver.quit()
+
+
+def search_product_url(base_url, product_code):
+    backend = SeleniumBackend(base_url, headless=False)
+    try:
+        return backend.lookup(product_code)
     except Exception as e:
         print("Error:", traceback.format_exc())
         return None
+    finally:
+        backend.close()
+
+
+def resolve_product_urls(product_codes, backend_factory, workers=2, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Image url of many product codes.
+
+    backend_factory() creates a backend: an object with lookup(product_code) -> url or None and close(),
+    for example lambda: SeleniumBackend("https://www.prisa.cl"). At most workers backends are created
+    and reused for every code (a backend that fails is closed and replaced).
+    Codes are compared as text. Found urls are kept in cache_dir (product_urls, code -> url) and known codes
+    are never looked up again;
+    codes that were not found are tried again on the next run.
+
+    Returns a frame with Code, URL (None when not found), Cached and Error
+    """
+    codes = list(dict.fromkeys(str(code) for code in product_codes))
+    cache_path = os.path.join(cache_dir, "product_urls") if cache_dir else None
+    cached = load_frame(cache_path) if cache_path else None
+    known = dict(zip(cached["Code"].astype(str), cached["URL"])) if cached is not None else {}
 
+    missing = [code for code in codes if code not in known]
+    backends = queue.Queue()
+    created = []
+    # filled as the lookups finish, so an interrupted run still caches what it found
+    results = {}
+    lock = threading.Lock()
+
+    def lookup(code):
+        try:
+            backend = backends.get_nowait()
+        except queue.Empty:
+            backend = backend_factory()
+            with lock:
+                created.append(backend)
+        try:
+            url = backend.lookup(code)
+        except Exception as e:
+            with lock:
+                created.remove(backend)
+                results[code] = None, f"{type(e).__name__}: {e}"
+            backend.close()
+            return
+        backends.put(backend)
+        with lock:
+            results[code] = url, None
+
+    try:
+        if missing:
+            with ThreadPoolExecutor(max(1, workers)) as pool:
+                list(pool.map(lookup, missing))
     finally:
-        driver.quit()
+        for backend in created:
+            backend.close()
+        found = {code: url for code, (url, error) in results.items() if url}
+        if found and cache_path:
+            known.update(found)
+            save_frame(pd.DataFrame({"Code": list(known), "URL": list(known.values())}), cache_path)
+
+    rows = []
+    for code in codes:
+        url, error = results.get(code, (known.get(code), None))
+        rows.append({"Code": code, "URL": url, "Cached": code not in results, "Error": error})
+    return pd.DataFrame(rows, columns=["Code", "URL", "Cached", "Error"])
 
 
 def download_and_save(folder, product_code, url, local_folder):
@@ -59,19 +154,104 @@ def download_and_save(folder, product_code, url, local_folder):
 
 
 
+def make_session(pool_size=8, retries=3, backoff=0.5):
+    """
+    requests session with pool_size pooled connections per host, retrying GETs on connection errors
+    and on 429/5xx answers with exponential backoff (backoff, 2 * backoff, 4 * backoff... seconds)
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(["GET"]), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def cached_object_path(cache_dir, digest):
+    """Path of the content with this sha256 in the cache: objects/ab/abcdef..."""
+    return os.path.join(cache_dir, "objects", digest[:2], digest)
+
+
+def fetch_to_cache(session, url, cache_dir, timeout=30):
+    """Downloads url into the content addressed cache, returns (sha256 digest, None) or (None, error message)"""
+    try:
+        response = session.get(url, timeout=timeout)
+    except requests.RequestException as e:
+        return None, f"{type(e).__name__}: {e}"
+    if response.status_code != 200:
+        return None, f"Status code {response.status_code}"
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    path = cached_object_path(cache_dir, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # one temporary name per thread, two urls can have the same content
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(response.content)
+        os.replace(tmp, path)
+    return digest, None
+
+
+def download_images(items, local_folder=None, cache_dir=IMAGE_CACHE_DIR, workers=8, timeout=30, retries=3,
+                    backoff=0.5, session=None):
+    """
+    Downloads the images of many (product_code, url) pairs.
+
+    The urls are fetched concurrently (workers threads sharing one pooled session, see make_session)
+    into a content addressed cache: every image is stored once under its sha256 and the url -> sha256 map
+    is kept in cache_dir, so urls downloaded by an earlier run are not downloaded again.
+    With local_folder every image is also copied as <product_code>.png, like download_and_save.
+
+    Returns a frame with Code, URL, Path (the cached file, None on error), Cached (True when no download
+    was needed) and Error
+    """
+    items = [(code, url) for code, url in items]
+    url_map_path = os.path.join(cache_dir, "urls")
+    url_map = load_frame(url_map_path)
+    known = dict(zip(url_map["URL"], url_map["Digest"])) if url_map is not None else {}
+    # a cached url whose file was removed is downloaded again
+    known = {url: digest for url, digest in known.items() if os.path.exists(cached_object_path(cache_dir, digest))}
+
+    missing = list(dict.fromkeys(url for _, url in items if url and url not in known))
+    fetched = {}
+    if missing:
+        own_session = session is None
+        session = session or make_session(workers, retries, backoff)
+        try:
+            with ThreadPoolExecutor(max(1, workers)) as pool:
+                results = pool.map(lambda url: fetch_to_cache(session, url, cache_dir, timeout), missing)
+                fetched = dict(zip(missing, results))
+        finally:
+            if own_session:
+                session.close()
+
+    new = {url: digest for url, (digest, error) in fetched.items() if digest is not None}
+    if new:
+        known.update(new)
+        save_frame(pd.DataFrame({"URL": list(known), "Digest": list(known.values())}), url_map_path)
+
+    rows = []
+    for code, url in items:
+        digest = known.get(url)
+        error = fetched[url][1] if url in fetched else (None if url else "No url")
+        path = cached_object_path(cache_dir, digest) if digest else None
+        if path and local_folder:
+            os.makedirs(local_folder, exist_ok=True)
+            target = os.path.join(local_folder, f"{code}.png")
+            if not os.path.exists(target) or file_digest(target) != digest:
+                shutil.copyfile(path, target)
+        rows.append({"Code": code, "URL": url, "Path": path, "Cached": url not in fetched and digest is not None,
+                     "Error": error})
+    return pd.DataFrame(rows, columns=["Code", "URL", "Path", "Cached", "Error"])
+
+
 if __name__ == "__main__":
     base_url = "https://www.prisa.cl"
-    product_code = "89295"
-    result = search_product_url(base_url, product_code)
-    print("Resultado:", result)
-
     LOCAL_FOLDER = "/home/viktoria/Downloads/images"
-    download_and_save(LOCAL_FOLDER, product_code, result, LOCAL_FOLDER)
-
-    code = 12596
-    result = search_product_url(base_url, code)
-    download_and_save(LOCAL_FOLDER, code, result, LOCAL_FOLDER)
 
-    code = 99840
-    result = search_product_url(base_url, code)
-    download_and_save(LOCAL_FOLDER, code, result, LOCAL_FOLDER)
\ No newline at end of file
+    urls = resolve_product_urls(["89295", 12596, 99840], lambda: SeleniumBackend(base_url), workers=2)
+    print(urls)
+    found = urls.dropna(subset=["URL"])
+    print(download_images(zip(found["Code"], found["URL"]), LOCAL_FOLDER))